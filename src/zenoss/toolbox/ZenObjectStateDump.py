@@ -0,0 +1,155 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2016, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+'''
+Streaming reader of the object_state rows held in a mysqldump of a RelStorage database,
+as used by "zodbscan --dump" to check a backup instead of the live database.
+
+Accepts a plain or gzipped mysqldump file, or a zenbackup tgz (the <database>.sql.gz
+member is read).  The dump is parsed one INSERT statement (one line) at a time, so
+memory use is bounded by mysqldump's statement size rather than by the database size.
+'''
+
+import os
+import re
+import tarfile
+import zlib
+
+from binascii import unhexlify
+
+_use = re.compile(r"^USE `([^`]+)`;")
+_create_table = re.compile(r"^CREATE TABLE `object_state` \(")
+_column = re.compile(r"^\s+`([^`]+)`")
+_insert = re.compile(r"^INSERT INTO `object_state`(?: \(([^)]*)\))? VALUES ")
+_value = r"(?:_binary )?('[^'\\]*(?:\\.[^'\\]*)*'|0x[0-9A-Fa-f]*|NULL|-?\d+)"   # MySQL 8 adds _binary
+_escape = re.compile(r"\\(.)", re.S)
+_unescapes = dict((chr(c), chr(c)) for c in xrange(256))
+_unescapes.update({'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'})
+
+DEFAULT_COLUMNS = ('zoid', 'tid', 'state_size', 'state')
+CHUNK = 1024*1024
+
+
+def gunzip_lines(fileobj):
+    '''Yields the lines of a gzip stream, reading fileobj forward only (tar members cannot seek back)'''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ''
+    data = fileobj.read(CHUNK)
+    while data:
+        lines = (pending + decompressor.decompress(data)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        data = fileobj.read(CHUNK)
+    pending += decompressor.flush()
+    if pending:
+        yield pending
+
+
+def parse_value(token):
+    '''Converts a mysqldump literal into an int/long, a str or None'''
+    if token[0] == "'":
+        body = token[1:-1]
+        if '\\' not in body:
+            return body
+        pieces = _escape.split(body)     # text, escaped char, text, ...
+        pieces[1::2] = map(_unescapes.__getitem__, pieces[1::2])
+        return ''.join(pieces)
+    if token.startswith('0x'):
+        return unhexlify(token[2:])
+    if token == 'NULL':
+        return None
+    return long(token)
+
+
+class ObjectStateDump(object):
+    '''
+    Iterates (zoid, tid, state) over the object_state rows of a dump:
+
+        >>> dump = ObjectStateDump('/opt/zenoss/backups/zenbackup_20160101.tgz', 'zodb')
+        >>> for zoid, tid, state in dump:
+        ...     print dump.progress()
+    '''
+
+    def __init__(self, filename, database='zodb'):
+        self.filename = filename
+        self.database = database
+        self.size = os.path.getsize(filename)
+        self._raw = None
+
+    def progress(self):
+        '''Fraction of the dump file read so far'''
+        if self._raw is None or self._raw.closed or not self.size:
+            return 0.0
+        return min(1.0, float(self._raw.tell()) / self.size)
+
+    def _open(self):
+        '''Returns a line iterable of the SQL text; self._raw is the underlying file'''
+        self._raw = open(self.filename, 'rb')
+        if tarfile.is_tarfile(self.filename):
+            archive = tarfile.open(fileobj=self._raw, mode='r|*')
+            names = ('%s.sql.gz' % (self.database), '%s.sql' % (self.database))
+            for member in archive:
+                if os.path.basename(member.name) in names:
+                    sql = archive.extractfile(member)
+                    return gunzip_lines(sql) if member.name.endswith('.gz') else iter(sql.readline, '')
+            raise ValueError("%s holds no %s dump" % (self.filename, ' or '.join(names)))
+        gzipped = self._raw.read(2) == '\x1f\x8b'
+        self._raw.seek(0)
+        return gunzip_lines(self._raw) if gzipped else iter(self._raw)
+
+    def __iter__(self):
+        sql = self._open()
+        try:
+            database = None
+            columns = DEFAULT_COLUMNS
+            row = None
+            lines = iter(sql)
+            for line in lines:
+                if line.startswith('USE '):
+                    match = _use.match(line)
+                    if match:
+                        database = match.group(1)
+                elif database not in (None, self.database):
+                    continue
+                elif line.startswith('CREATE TABLE') and _create_table.match(line):
+                    names = []
+                    for column_line in lines:
+                        match = _column.match(column_line)
+                        if not match:
+                            break
+                        names.append(match.group(1))
+                    columns = tuple(names)
+                    row = None
+                elif line.startswith('INSERT INTO'):
+                    match = _insert.match(line)
+                    if not match:
+                        continue
+                    if match.group(1):
+                        columns = tuple(name.strip(' `') for name in match.group(1).split(','))
+                        row = None
+                    if row is None:
+                        row = re.compile(r"\(%s\)([,;])" % (','.join([_value]*len(columns))))
+                        positions = [columns.index(name) + 1 for name in ('zoid', 'tid', 'state')]
+                    # Tuples follow each other with no gap: anything unmatched is an error, never skipped
+                    position = match.end()
+                    while True:
+                        values = row.match(line, position)
+                        if not values:
+                            raise ValueError("Cannot parse object_state row at offset %d: %.80r" %
+                                             (position, line[position:]))
+                        zoid, tid, state = [values.group(group) for group in positions]
+                        yield long(zoid), long(tid), parse_value(state)
+                        position = values.end()
+                        if values.group(len(columns) + 1) == ';':
+                            break
+                    if line[position:].strip():
+                        raise ValueError("Unexpected text after object_state rows: %.80r" % (line[position:]))
+        finally:
+            self._raw.close()
@@ -0,0 +1,230 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2016, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+'''
+On-disk reference graph of a ZODB database, as written by "zodbscan --export-refs".
+
+The file holds the forward edges (source zoid -> target zoid) and the reverse edges
+(target zoid -> referring zoids) as two compressed sparse row indexes of little-endian
+u64 values, so it can be memory-mapped and queried without touching MySQL:
+
+    header      magic, forward node count, edge count, reverse node count
+    forward     sorted source zoids, node offsets (count + 1), target zoids
+    reverse     sorted target zoids, node offsets (count + 1), referring zoids
+'''
+
+import mmap
+import os
+import struct
+import tempfile
+
+from array import array
+from collections import deque
+
+MAGIC = 'ZENREFG1'
+ROOT_ZOID = 1
+ZOID_TYPECODE = 'L'     # unsigned long is 64 bits on the x86_64 Linux platforms Zenoss runs on
+CHUNK = 1024*1024       # zoids per bulk read/write
+
+_header = struct.Struct('<8sQQQ')
+_u64 = struct.Struct('<Q')
+_u64_pair = struct.Struct('<QQ')
+
+
+class RefGraphPart(object):
+    '''Edge list of one zoid slice, written by a scan worker in ascending source order'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'wb')
+
+    def add(self, source, targets):
+        record = array(ZOID_TYPECODE, [source, len(targets)])
+        record.extend(targets)
+        record.tofile(self._file)
+
+    def close(self):
+        self._file.close()
+
+
+def iter_part(filename):
+    '''Yields (source, targets) for every record of a RefGraphPart file'''
+    data = array(ZOID_TYPECODE)
+    with open(filename, 'rb') as f:
+        data.fromstring(f.read())
+    index = 0
+    while index < len(data):
+        source, count = data[index], data[index + 1]
+        yield source, data[index + 2:index + 2 + count]
+        index += 2 + count
+
+
+def _copy(src, dst):
+    src.seek(0)
+    block = src.read(8*CHUNK)
+    while block:
+        dst.write(block)
+        block = src.read(8*CHUNK)
+
+
+def write_refgraph(filename, parts):
+    '''
+    Merges RefGraphPart files, given in ascending zoid slice order, into a reference graph
+    file.  The forward index is copied sequentially; the reverse index is built with a
+    counting sort over the target zoids, so it takes two passes over the edges.
+    '''
+    directory = os.path.dirname(os.path.abspath(filename))
+    sources, offsets, targets = [tempfile.TemporaryFile(dir=directory) for _ in xrange(3)]
+    node_count = edge_count = 0
+    counts = array(ZOID_TYPECODE)
+    try:
+        for part in parts:
+            part_sources, part_offsets = array(ZOID_TYPECODE), array(ZOID_TYPECODE)
+            for source, part_targets in iter_part(part):
+                node_count += 1
+                edge_count += len(part_targets)
+                part_sources.append(source)
+                part_offsets.append(edge_count)
+                part_targets.tofile(targets)
+                for target in part_targets:
+                    if target >= len(counts):
+                        counts.extend(array(ZOID_TYPECODE, [0]) * (max(target + 1, 2*len(counts)) - len(counts)))
+                    counts[target] += 1
+            part_sources.tofile(sources)
+            part_offsets.tofile(offsets)
+
+        with open(filename, 'w+b') as out:
+            out.write(_header.pack(MAGIC, 0, 0, 0))
+            _copy(sources, out)
+            array(ZOID_TYPECODE, [0]).tofile(out)
+            _copy(offsets, out)
+            _copy(targets, out)
+
+            # counts[] becomes the next free slot of every target in the referrers section
+            reverse_sources, reverse_offsets = array(ZOID_TYPECODE), array(ZOID_TYPECODE, [0])
+            position = 0
+            for zoid, count in enumerate(counts):
+                if count:
+                    reverse_sources.append(zoid)
+                    counts[zoid] = position
+                    position += count
+                    reverse_offsets.append(position)
+            reverse_sources.tofile(out)
+            reverse_offsets.tofile(out)
+            referrers_at = out.tell()
+            out.truncate(referrers_at + 8*edge_count)
+            out.seek(0)
+            out.write(_header.pack(MAGIC, node_count, edge_count, len(reverse_sources)))
+            out.flush()
+
+            if edge_count:
+                referrers = mmap.mmap(out.fileno(), 0)
+                try:
+                    for part in parts:
+                        for source, part_targets in iter_part(part):
+                            for target in part_targets:
+                                _u64.pack_into(referrers, referrers_at + 8*counts[target], source)
+                                counts[target] += 1
+                    referrers.flush()
+                finally:
+                    referrers.close()
+    finally:
+        for f in (sources, offsets, targets):
+            f.close()
+
+    return node_count, edge_count
+
+
+class RefGraph(object):
+    '''
+    Read-only, memory-mapped access to a reference graph file:
+
+        >>> graph = RefGraph('/tmp/zodb.refs')
+        >>> graph.referrers(0x1234)           # who references 0x1234
+        >>> graph.retention_path(0x1234)      # why is 0x1234 kept (root ... 0x1234)
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.node_count, self.edge_count, self.referenced_count = _header.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not a zodbscan reference graph" % (filename))
+        self._forward = (_header.size, self.node_count)
+        self._reverse = (_header.size + 8*(2*self.node_count + 1 + self.edge_count), self.referenced_count)
+
+    def close(self):
+        if not self._file.closed:
+            self._map.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _lookup(self, index, zoid):
+        '''Binary search of zoid in an index, returning its adjacent zoids'''
+        nodes_at, count = index
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _u64.unpack_from(self._map, nodes_at + 8*mid)[0] < zoid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == count or _u64.unpack_from(self._map, nodes_at + 8*lo)[0] != zoid:
+            return ()
+        offsets_at = nodes_at + 8*count
+        start, end = _u64_pair.unpack_from(self._map, offsets_at + 8*lo)
+        edges_at = offsets_at + 8*(count + 1)
+        return struct.unpack_from('<%dQ' % (end - start), self._map, edges_at + 8*start)
+
+    def references(self, zoid):
+        '''Zoids referenced by zoid'''
+        return self._lookup(self._forward, zoid)
+
+    def referrers(self, zoid):
+        '''Zoids that reference zoid'''
+        return self._lookup(self._reverse, zoid)
+
+    def subtree(self, zoid):
+        '''Set of zoids reachable from zoid, zoid included'''
+        seen = set([zoid])
+        queue = deque([zoid])
+        while queue:
+            for ref in self.references(queue.popleft()):
+                if ref not in seen:
+                    seen.add(ref)
+                    queue.append(ref)
+        return seen
+
+    def retention_path(self, zoid, root=ROOT_ZOID):
+        '''Shortest reference chain [root, ..., zoid], or None if zoid is not reachable from root'''
+        parents = {zoid: None}
+        queue = deque([zoid])
+        while queue:
+            current = queue.popleft()
+            if current == root:
+                path = []
+                while current is not None:
+                    path.append(current)
+                    current = parents[current]
+                return path
+            for ref in self.referrers(current):
+                if ref not in parents:
+                    parents[ref] = current
+                    queue.append(ref)
+        return None
+
+    def is_reachable(self, zoid, root=ROOT_ZOID):
+        return self.retention_path(zoid, root) is not None
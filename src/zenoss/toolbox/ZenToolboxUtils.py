@@ -9,12 +9,20 @@
 
 import argparse
 import logging
+import marshal
+import multiprocessing
 import os
 import socket
 import sys
+import tempfile
+import threading
 import time
+import transaction
 
+from collections import OrderedDict, deque
 from multiprocessing import Lock, Value
+from Products.ZenUtils.ZenScriptBase import ZenScriptBase
+from ZODB.POSException import ConflictError
 
 
 def configure_logging(name, version, tmpdir):
@@ -76,6 +84,72 @@ def inline_print(message):
     sys.stdout.flush()
 
 
+class QueueLogHandler(logging.Handler):
+    '''Hands the log records of a worker process to the coordinator's WorkerLogListener'''
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            # Arguments and tracebacks may not pickle, so they cross the queue rendered
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            record.msg = record.getMessage()
+            record.args = None
+            self.queue.put(record)
+        except Exception:
+            self.handleError(record)
+
+
+class WorkerLogListener(object):
+    '''
+    Coordinator side of worker logging: a thread passes the records that worker processes
+    put on queue to the handlers of log, so only the coordinator writes (and rotates) the
+    log file.  Create it before the workers are started, stop() it after they are done.
+    '''
+    def __init__(self, log):
+        self.log = log
+        self.queue = multiprocessing.Queue()
+        self._thread = threading.Thread(target=self._run, name="worker-log-listener")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.log.handle(record)
+
+    def stop(self):
+        self.queue.put(None)
+        self._thread.join()
+
+
+def log_to_queue(log, queue):
+    '''Redirects log in a worker process to the coordinator's WorkerLogListener queue'''
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    log.addHandler(QueueLogHandler(queue))
+    log.propagate = False
+
+
+def init_worker(log=None, log_queue=None):
+    '''
+    Prepares a --workers process of a tool, returning its own ZenScriptBase dmd connection.
+    Given a WorkerLogListener queue, the records of log are written by the coordinator.
+    '''
+    # The coordinator draws the progress bar; worker output would garble it
+    with open(os.devnull, 'w') as f:
+        os.dup2(f.fileno(), sys.stdout.fileno())
+    dmd = ZenScriptBase(noopts=True, connect=True).dmd
+    if log_queue is not None:
+        log_to_queue(log, log_queue)
+    return dmd
+
+
 class Counter(object):
     def __init__(self, initval=0):
         self.val = Value('i', initval)
@@ -85,6 +159,10 @@ class Counter(object):
         with self.lock:
             self.val.value += 1
 
+    def add(self, amount):
+        with self.lock:
+            self.val.value += amount
+
     def value(self):
         with self.lock:
             return self.val.value
@@ -94,6 +172,190 @@ class Counter(object):
             self.val.value = 0
 
 
+class LRUCache(object):
+    '''Bounded mapping that evicts the least recently used entry once size entries are held'''
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+
+class SpillQueue(object):
+    '''
+    FIFO of marshallable entries that keeps at most ~2*size of them in memory; the
+    entries in between are spilled, size at a time, to temporary files under tmpdir
+    holding up to FILE_BATCHES batches each.  A file is closed (and its disk space
+    released) as soon as its last batch is read back, so disk use follows the spilled
+    entries.  Order is _head, then the spilled batches, then _tail; every operation is O(1).
+    '''
+    FILE_BATCHES = 16
+
+    def __init__(self, tmpdir, size=100000):
+        self.tmpdir = tmpdir
+        self.size = size
+        self._head = deque()
+        self._tail = deque()
+        self._files = deque()       # [file, batches written, read offset, entries unread], oldest first
+        self._spilled = 0           # entries written to the spill files and not yet read back
+
+    def __len__(self):
+        return len(self._head) + self._spilled + len(self._tail)
+
+    def append(self, entry):
+        self._tail.append(entry)
+        if len(self._tail) >= self.size:
+            if not self._files or self._files[-1][1] >= self.FILE_BATCHES:
+                self._files.append([tempfile.TemporaryFile(dir=self.tmpdir), 0, 0, 0])
+            spill = self._files[-1]
+            spill[0].seek(0, os.SEEK_END)
+            while self._tail:
+                marshal.dump(self._tail.popleft(), spill[0])
+                spill[3] += 1
+                self._spilled += 1
+            spill[1] += 1
+
+    def popleft(self):
+        if not self._head:
+            if self._spilled:
+                spill = self._files[0]
+                spill[0].seek(spill[2])
+                for _ in xrange(min(self.size, spill[3])):
+                    self._head.append(marshal.load(spill[0]))
+                    spill[3] -= 1
+                    self._spilled -= 1
+                spill[2] = spill[0].tell()
+                if not spill[3]:
+                    spill[0].close()
+                    self._files.popleft()
+            else:
+                self._head, self._tail = self._tail, self._head
+        return self._head.popleft()
+
+    def close(self):
+        while self._files:
+            self._files.popleft()[0].close()
+        self._spilled = 0
+
+
+class PathTable(object):
+    '''
+    Interned traversal paths: a path is held once as (parent path id, name) and shared,
+    by id, by the queued entries of its children.  Reference counts drop a path (and,
+    in turn, its ancestors) once nothing uses it.  A path with no parent id holds its
+    full tuple of names, for scan roots and revisited paths.
+    '''
+    def __init__(self):
+        self._paths = {}    # id -> [parent id, name or names, references]
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._paths)
+
+    def intern(self, parent_id, name):
+        '''Returns the id of a new path, with one reference held by the caller'''
+        path_id = self._next_id
+        self._next_id += 1
+        self._paths[path_id] = [parent_id, name, 1]
+        if parent_id is not None:
+            self._paths[parent_id][2] += 1
+        return path_id
+
+    def acquire(self, path_id):
+        self._paths[path_id][2] += 1
+
+    def release(self, path_id):
+        while path_id is not None:
+            record = self._paths[path_id]
+            record[2] -= 1
+            if record[2]:
+                break
+            del self._paths[path_id]
+            path_id = record[0]
+
+    def path(self, path_id):
+        '''Returns the tuple of names of a path, rebuilt in O(depth)'''
+        names = []
+        record = self._paths[path_id]
+        while record[0] is not None:
+            names.append(record[1])
+            record = self._paths[record[0]]
+        names.reverse()
+        return tuple(record[1]) + tuple(names)
+
+
+class TransactionBatch(object):
+    '''
+    Groups repairs into shared transactions: every repair (a no-argument callable) is
+    applied and savepointed, and the transaction is committed once size repairs are
+    pending or interval seconds have passed.  On ConflictError the transaction is
+    aborted and the pending repairs are replayed against fresh state, up to retries times;
+    on any other error it is aborted and the pending repairs are logged as dropped.
+    A repair already applied by the caller is added with applied=True.
+    '''
+    def __init__(self, log, size=100, interval=30, retries=3):
+        self.log = log
+        self.size = size
+        self.interval = interval
+        self.retries = retries
+        self._pending = []
+        self._started = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, repair, applied=False):
+        if not applied:
+            repair()
+        transaction.savepoint(optimistic=True)
+        self._pending.append(repair)
+        if self._started is None:
+            self._started = time.time()
+        if len(self._pending) >= self.size or (time.time() - self._started) >= self.interval:
+            self.commit()
+
+    def commit(self):
+        '''Commits the pending repairs, returns False if they were dropped (repeated conflicts or an error)'''
+        if not self._pending:
+            return True
+        pending, self._pending, self._started = self._pending, [], None
+        for attempt in xrange(self.retries + 1):
+            try:
+                if attempt:
+                    for repair in pending:
+                        repair()
+                transaction.commit()
+                return True
+            except ConflictError as e:
+                transaction.abort()
+                self.log.warning("ConflictError committing %d repairs (attempt %d of %d): %s",
+                                 len(pending), attempt + 1, self.retries + 1, e)
+            except Exception as e:
+                transaction.abort()
+                self.log.exception("Dropped %d repairs after %s: %s", len(pending), type(e).__name__, e)
+                return False
+        self.log.error("Dropped %d repairs after %d conflicting commits", len(pending), self.retries + 1)
+        return False
+
+
 def parse_options(scriptVersion, description_string):
     """Defines command-line options for script """
     parser = argparse.ArgumentParser(version=scriptVersion, description=description_string)
@@ -18,6 +18,7 @@ import argparse
 import datetime
 import Globals
 import logging
+import multiprocessing
 import os
 import re
 import sys
@@ -28,8 +29,13 @@ import ZenToolboxUtils
 
 from Products.ZenModel.Device import Device
 from Products.ZenModel.ZenStatus import ZenStatus
+from OFS.ObjectManager import ObjectManager
 from Products.ZenRelations.RelationshipBase import RelationshipBase
+from Products.ZenRelations.RelationshipManager import RelationshipManager
 from Products.ZenRelations.ToManyContRelationship import ToManyContRelationship
+from Products.ZenRelations.ToManyRelationship import ToManyRelationship
+from Products.ZenRelations.ToOneRelationship import ToOneRelationship
+from Products.ZenUtils.GlobalConfig import getGlobalConfiguration
 from Products.ZenUtils.Utils import unused
 from Products.ZenUtils.ZenScriptBase import ZenScriptBase
 from time import localtime, strftime
@@ -38,6 +44,7 @@ try:
 except ImportError:
     pass
 from ZenToolboxUtils import inline_print
+from zodbscan import PKEReporter
 from ZODB.POSException import POSKeyError
 from ZODB.utils import u64
 
@@ -58,20 +65,20 @@ class Fixer(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def fixable(self, ex, objId, parentPath, dmd, log):
+    def fixable(self, ex, objId, parent, log):
         """
         Return a no-argument callable object that will perform the fix
-        when invoked or None if not fixable.
+        when invoked or None if not fixable.  The callable must not commit:
+        it may be replayed if the batched transaction it joins conflicts.
         """
 
 
 class RelFixer(Fixer):
-    def fixable(self, ex, relId, parentPath, dmd, log):
+    def fixable(self, ex, relId, parent, log):
         """
         Return True if this object can fix the exception.
         """
         try:
-            parent = dmd.getObjByPath(parentPath)
             relationship = parent._getOb(relId)
             if not isinstance(relationship, RelationshipBase):
                 return None
@@ -82,19 +89,18 @@ class RelFixer(Fixer):
             exOID = getOID(ex)
             relOID = getPOID(relationship._objects)
             if exOID == relOID:
-                return lambda: self._fix(exOID, relOID, relationship, parent, dmd, log)
+                return lambda: self._fix(exOID, relOID, relationship, parent, log)
             else:
                 log.error("Cannot fix this relationship - exOID %s != relOID %s", exOID, relOID)
         except:
             return None
 
-    def _fix(self, exOID, relOID, relationship, parent, dmd, log):
+    def _fix(self, exOID, relOID, relationship, parent, log):
         """ Attempt to fix the POSKeyError """
         log.info("Repairing '_objects' attribute on %s", parent)
         cls = relationship._objects.__class__
         relationship._objects = cls()
         parent._p_changed = True
-        transaction.commit()
 
 
 class SearchManagerFixer(Fixer):
@@ -109,36 +115,33 @@ class SearchManagerFixer(Fixer):
     # >>> d=_
     # >>> d._delOb('SearchManager')
     # >>> commit()
-    def fixable(self, ex, objId, parentPath, dmd, log):
+    def fixable(self, ex, objId, parent, log):
         """ Return True if this object can fix the exception.  """
         if objId != 'SearchManager':
             return None
 
-        parent = dmd.getObjByPath(parentPath)
         obj = parent._getOb(objId)
         if not isinstance(obj, SearchManager):
             return None
         exOID = getOID(ex)
         relOID = getPOID(obj)
         if exOID == relOID:
-            return lambda: self._fix(exOID, parent, dmd, log)
+            return lambda: self._fix(exOID, parent, log)
 
         return None
 
-    def _fix(self, exOID, parent, dmd, log):
+    def _fix(self, exOID, parent, log):
         """ Delete only; a new one will be created when a SearchProvider is requested.  """
         try:
             log.info("Repairing 'SearchManager' attribute on %s", parent)
             parent._delOb('SearchManager')
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
         try:
             parent._setObject(SEARCH_MANAGER_ID, SearchManager(SEARCH_MANAGER_ID))
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
 
 class ComponentSearchFixer(Fixer):
@@ -147,34 +150,31 @@ class ComponentSearchFixer(Fixer):
         POSKeyError: 0x070039e0 on attribute 'componentSearch' of app.zport.dmd.Devices.Network.Juniper.mx.mx_240.devices.edge1.fra
     """
 
-    def fixable(self, ex, objId, parentPath, dmd, log):
+    def fixable(self, ex, objId, parent, log):
         """ Return True if this object can fix the exception.  """
         if objId != 'componentSearch':
             return None
 
-        parent = dmd.getObjByPath(parentPath)
         obj = parent._getOb(objId)
         exOID = getOID(ex)
         relOID = getPOID(obj)
         if exOID == relOID:
-            return lambda: self._fix(exOID, parent, dmd, log)
+            return lambda: self._fix(exOID, parent, log)
 
         return None
 
-    def _fix(self, exOID, parent, dmd, log):
+    def _fix(self, exOID, parent, log):
         """ Attempt to remove and recreate the componentSearch() """
         try:
             log.info("Repairing 'componentSearch' attribute on %s", parent)
             parent._delOb('componentSearch')
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
         try:
             parent._create_componentSearch()
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
 
 class OperatingSystemFixer(Fixer):
@@ -183,22 +183,21 @@ class OperatingSystemFixer(Fixer):
         POSKeyError: 0x9782ff on attribute 'os' of /zport/dmd/Devices/Web/SSL/devices/YOUR_DEVICE_HERE
     """
 
-    def fixable(self, ex, objId, parentPath, dmd, log):
+    def fixable(self, ex, objId, parent, log):
         """ Return True if this object can fix the exception.  """
 
         if objId != 'os':
             return None
 
-        parent = dmd.getObjByPath(parentPath)
         obj = parent._getOb(objId)
         exOID = getOID(ex)
         relOID = getPOID(obj)
         if exOID == relOID:
-            return lambda: self._fix(exOID, parent, dmd, log)
+            return lambda: self._fix(exOID, parent, log)
 
         return None
 
-    def _fix(self, exOID, parent, dmd, log):
+    def _fix(self, exOID, parent, log):
         """ Attempt to remove and recreate the os object """
         from Products.ZenModel.OperatingSystem import OperatingSystem
         try:
@@ -206,14 +205,12 @@ class OperatingSystemFixer(Fixer):
             parent._delOb('os')
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
         try:
             temp_os_comp = OperatingSystem()
             parent._setObject(temp_os_comp.id, temp_os_comp)
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
 
 class HardwareFixer(Fixer):
@@ -222,22 +219,21 @@ class HardwareFixer(Fixer):
         POSKeyError: 0x9782fb on attribute 'hw' of /zport/dmd/Devices/Web/SSL/devices/YOUR_DEVICE_HERE
     """
 
-    def fixable(self, ex, objId, parentPath, dmd, log):
+    def fixable(self, ex, objId, parent, log):
         """ Return True if this object can fix the exception.  """
 
         if objId != 'hw':
             return None
 
-        parent = dmd.getObjByPath(parentPath)
         obj = parent._getOb(objId)
         exOID = getOID(ex)
         relOID = getPOID(obj)
         if exOID == relOID:
-            return lambda: self._fix(exOID, parent, dmd, log)
+            return lambda: self._fix(exOID, parent, log)
 
         return None
 
-    def _fix(self, exOID, parent, dmd, log):
+    def _fix(self, exOID, parent, log):
         """ Attempt to remove and recreate the hw object """
         from Products.ZenModel.DeviceHW import DeviceHW
         try:
@@ -245,24 +241,66 @@ class HardwareFixer(Fixer):
             parent._delOb('hw')
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
         try:
             temp_hw_comp = DeviceHW()
             parent._setObject(temp_hw_comp.id, temp_hw_comp)
         except Exception as e:
             log.exception(e)
-        transaction.commit()
 
-_fixits = [RelFixer(), SearchManagerFixer(), ComponentSearchFixer(), OperatingSystemFixer(), HardwareFixer(), ]
+# Fixers by the id of the attribute that raised; every other id is tried as a relationship
+_fixits = {
+    'SearchManager': SearchManagerFixer(),
+    'componentSearch': ComponentSearchFixer(),
+    'os': OperatingSystemFixer(),
+    'hw': HardwareFixer(),
+    }
+_relFixer = RelFixer()
+
+
+# Meta types of the relationships listed in a RelationshipManager's _objects
+_RELMETATYPES = frozenset(klass.meta_type for klass in (ToOneRelationship, ToManyRelationship, ToManyContRelationship))
+
+# Per class: (is a Device, has objectIds, has getRelationshipNames, children listed by _objects)
+_edgeSchemas = {}
+
+
+def _isMethod(klass, name, method):
+    return getattr(getattr(klass, name, None), 'im_func', None) is method.im_func
+
+
+def _getEdgeSchema(obj):
+    """
+    The node kind only depends on the class, so it is computed once per class.  The
+    relationship names are not cached: they are the relations an instance actually
+    holds, which differ from the class _relations when a ZenPack added or removed
+    relations after the instance was created.  Classes keeping the stock OFS objectIds
+    and ZenRelations getRelationshipNames list both from the instance's _objects.
+    """
+    klass = obj.__class__
+    schema = _edgeSchemas.get(klass)
+    if schema is None:
+        has_relationships = hasattr(obj, "getRelationshipNames")
+        schema = (
+            isinstance(obj, Device),
+            hasattr(obj, "objectIds"),
+            has_relationships,
+            _isMethod(klass, "objectIds", ObjectManager.objectIds) and
+            (not has_relationships or
+             _isMethod(klass, "getRelationshipNames", RelationshipManager.getRelationshipNames))
+        )
+        _edgeSchemas[klass] = schema
+    return schema
 
 
-def _getEdges(node, path_string, attempt_fix, counters, log):
-    cls = node.aq_base
+def _getEdges(node, path_string, attempt_fix, counters, log, repairs=None):
+    """ Returns (attribute names, relationship names) of the children of node """
+    base = node.aq_base
     attempted_fix = False
+    is_device, has_children, has_relationships, lists_objects = _getEdgeSchema(base)
 
     # Fixes ZEN-18368: findposkeyerror should detect/fix _lastPollSnmpUpTime
-    if isinstance(node, Device):
+    if is_device:
         try:
             try:
                 counters['item_count'].increment()
@@ -273,8 +311,7 @@ def _getEdges(node, path_string, attempt_fix, counters, log):
                 if attempt_fix:
                     counters['repair_count'].increment()
                     attempted_fix = True
-                    node._lastPollSnmpUpTime = ZenStatus(0)
-                    transaction.commit()
+                    repairs.add(lambda: setattr(node, '_lastPollSnmpUpTime', ZenStatus(0)))
                 raise
         except Exception as e:
             counters['error_count'].increment()
@@ -282,12 +319,21 @@ def _getEdges(node, path_string, attempt_fix, counters, log):
         if attempted_fix:
             log.info("Repairing '_lastPollSnmpUpTime' attribute on %s", node)
 
-    names = set(node.objectIds() if hasattr(cls, "objectIds") else [])
-    relationships = set(
-        node.getRelationshipNames()
-        if hasattr(cls, "getRelationshipNames") else []
-    )
-    return (names - relationships), relationships
+    if lists_objects:
+        # One walk of _objects, split by meta type as getRelationshipNames() does
+        attributes, relationships = [], []
+        for entry in base._objects:
+            if has_relationships and entry.get('meta_type') in _RELMETATYPES:
+                relationships.append(entry['id'])
+            else:
+                attributes.append(entry['id'])
+        return attributes, relationships
+    relationships = frozenset(node.getRelationshipNames() if has_relationships else [])
+    if not has_children:
+        return (), relationships
+    if not relationships:
+        return list(node.objectIds()), relationships
+    return [name for name in node.objectIds() if name not in relationships], relationships
 
 
 _RELEVANT_EXCEPTIONS = (POSKeyError, KeyError, AttributeError)
@@ -297,7 +343,7 @@ def _getPathStr(path):
     return "app%s" % ('.'.join(path)) if len(path) > 1 else "app"
 
 
-def fixPOSKeyError(exname, ex, objType, objId, parentPath, dmd, log, counters):
+def fixPOSKeyError(exname, ex, objType, objId, parentPath, dmd, log, counters, repairs):
     """
     Fixes POSKeyErrors given:
         Name of exception type object,
@@ -305,13 +351,19 @@ def fixPOSKeyError(exname, ex, objType, objId, parentPath, dmd, log, counters):
         Type of problem object,
         Name (ID) of the object,
         The path to the parent of the named object
+    The fix joins the current repairs batch (a ZenToolboxUtils.TransactionBatch).
     """
+    try:
+        parent = dmd.getObjByPath(parentPath)
+    except Exception as e:
+        log.error("Cannot fix %s on %s - %s: %s", objId, "/".join(parentPath), type(e).__name__, e)
+        return
     # -- verify that the OIDs match
-    for fixer in _fixits:
-        fix = fixer.fixable(ex, objId, parentPath, dmd, log)
+    for fixer in (_fixits.get(objId), _relFixer):
+        fix = fixer and fixer.fixable(ex, objId, parent, log)
         if fix:
             counters['repair_count'].increment()
-            fix()
+            repairs.add(fix)
             break
 
 
@@ -324,8 +376,44 @@ def getOID(ex):
     return "0x%08x" % int(str(ex), 16)
 
 
-def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, counters, max_cycles):
-    """ Processes issues as they are found, handles progress output, logs to output file """
+def _frontierEntry(node, path_id, name=None):
+    """
+    Frontier entries are (oid, parent path id, name), path ids interned in a PathTable,
+    so that no live object, nor its full path, is held between visits.  Scan roots and
+    revisited paths are entered with their own path id and no name.
+    """
+    return (getattr(node, '_p_oid', None), path_id, name)
+
+
+def _materialize(oid, path, topnode):
+    """
+    Loads a frontier entry back from the connection, wrapped in the scan root's
+    acquisition context (the node's own path is rebuilt from the entry).  Objects
+    without an oid of their own are re-traversed from their path instead.
+    """
+    if oid is None:
+        return topnode.unrestrictedTraverse(path)
+    obj = topnode._p_jar.get(oid)
+    return obj.__of__(topnode) if hasattr(obj, '__of__') else obj
+
+
+def _addFailure(failures, path, name):
+    if path not in failures:
+        failures[path] = set([name])
+    elif failures[path] is not None:
+        failures[path].add(name)
+
+
+def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, counters, max_cycles,
+                     tmpdir, queue_size, split_depth=0, subtrees=None, commit_batch=100):
+    """
+    Processes issues as they are found, handles progress output, logs to output file.
+    If a subtrees list is given, nodes split_depth ids below the root are not traversed;
+    their paths are collected in subtrees (during the first cycle) to be scanned by workers.
+    Cycles after the first only revisit the failures of the previous cycle: the failing
+    attributes of each parent path (or the whole node) and everything below them.
+    Repairs are committed in batches of commit_batch, and before every cache release.
+    """
 
     PROGRESS_INTERVAL = 829  # Prime number near 1000 ending in a 9, used for progress bar
 
@@ -334,36 +422,68 @@ def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, count
         max_cycles = 1
     number_of_issues = -1
     number_of_repairs = -1
+    failures = None     # {parent path: set of failing names, or None for the whole node}
+    repairs = ZenToolboxUtils.TransactionBatch(log, commit_batch)
 
     while ((current_cycle < max_cycles) and (number_of_issues != 0) and (number_of_repairs != 0)):
-        # Objects that will have their children traversed are stored in 'nodes'
+        # Objects that will have their children traversed are queued (by oid and path id) in 'nodes'
         print
         current_cycle += 1
         log.info("## Beginning cycle %s of %s (potential)", current_cycle, max_cycles)
-        nodes = [topnode]
+        nodes = ZenToolboxUtils.SpillQueue(tmpdir, queue_size)
+        paths = ZenToolboxUtils.PathTable()
+        if failures is None:
+            nodes.append(_frontierEntry(topnode, paths.intern(None, topnode.getPhysicalPath())))
+        else:
+            log.info("Cycle %s revisits %d failing paths", current_cycle, len(failures))
+            for path in sorted(failures):
+                nodes.append((None, paths.intern(None, path), None))
+        retry, failures = failures or {}, {}
         counters['item_count'].reset()
         counters['error_count'].reset()
         counters['repair_count'].reset()
+        node_id = None
         while nodes:
-            node = nodes.pop(0)
-            counters['item_count'].increment()
-            path = node.getPhysicalPath()
+            if node_id is not None:
+                paths.release(node_id)      # the children of the previous node hold their own references
+            oid, path_id, name = nodes.popleft()
+            if name is None:
+                node_id = path_id
+            else:
+                node_id = paths.intern(path_id, name)
+                paths.release(path_id)
+            path = paths.path(node_id)
+            if subtrees is not None and len(path) - 1 == split_depth:
+                if current_cycle == 1:
+                    subtrees.append(path)
+                continue
             path_string = "/".join(path)
+            counters['item_count'].increment()
 
             if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
                 if not use_unlimited_memory:
+                    repairs.commit()
                     transaction.abort()
                 progress_bar(counters['item_count'].value(), counters['error_count'].value(),
                              counters['repair_count'].value(), attempt_fix, current_cycle)
 
             try:
-                attributes, relationships = _getEdges(node, path_string, attempt_fix, counters, log)
+                node = _materialize(oid, path, topnode)
+                errors_before = counters['error_count'].value()
+                attributes, relationships = _getEdges(node, path_string, attempt_fix, counters, log, repairs)
+                if counters['error_count'].value() != errors_before:
+                    failures.setdefault(path, set())
+                if oid is None and retry.get(path) is not None:
+                    names = retry[path]
+                    attributes = [name for name in attributes if name in names]
+                    relationships = [name for name in relationships if name in names]
             except _RELEVANT_EXCEPTIONS as e:
                 log.critical("%s: %s %s '%s'", type(e).__name__, e, "while retreiving children of", path_string)
                 counters['error_count'].increment()
+                failures[path] = None
                 if attempt_fix:
                     if isinstance(e, POSKeyError):
-                        fixPOSKeyError(type(e).__name__, e, "node", name, path, dmd, log, counters)
+                        fixPOSKeyError(type(e).__name__, e, "node", name, path, dmd, log, counters, repairs)
                 continue
             except Exception as e:
                 log.exception(e)
@@ -372,6 +492,7 @@ def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, count
                 try:
                     if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
                         if not use_unlimited_memory:
+                            repairs.commit()
                             transaction.abort()
                         progress_bar(counters['item_count'].value(), counters['error_count'].value(),
                                      counters['repair_count'].value(), attempt_fix, current_cycle)
@@ -381,7 +502,8 @@ def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, count
                     rel()
                     # ToManyContRelationship objects should have all referenced objects traversed
                     if isinstance(rel, ToManyContRelationship):
-                        nodes.append(rel)
+                        paths.acquire(node_id)
+                        nodes.append(_frontierEntry(rel, node_id, name))
                 except SystemError as e:
                     # to troubleshoot traceback in:
                     #   https://dev.zenoss.com/tracint/pastebin/4769
@@ -392,9 +514,10 @@ def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, count
                 except _RELEVANT_EXCEPTIONS as e:
                     counters['error_count'].increment()
                     log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
+                    _addFailure(failures, path, name)
                     if attempt_fix:
                         if isinstance(e, POSKeyError):
-                            fixPOSKeyError(type(e).__name__, e, "attribute", name, path, dmd, log, counters)
+                            fixPOSKeyError(type(e).__name__, e, "attribute", name, path, dmd, log, counters, repairs)
                 except Exception as e:
                     log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
 
@@ -402,6 +525,7 @@ def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, count
                 try:
                     if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
                         if not use_unlimited_memory:
+                            repairs.commit()
                             transaction.abort()
                         progress_bar(counters['item_count'].value(), counters['error_count'].value(),
                                      counters['repair_count'].value(), attempt_fix, current_cycle)
@@ -413,15 +537,19 @@ def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, count
                 except _RELEVANT_EXCEPTIONS as e:
                     counters['error_count'].increment()
                     log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "attribute", name, path_string)
+                    _addFailure(failures, path, name)
                     if attempt_fix:
                         if isinstance(e, POSKeyError):
-                            fixPOSKeyError(type(e).__name__, e, "attribute", name, path, dmd, log, counters)
+                            fixPOSKeyError(type(e).__name__, e, "attribute", name, path, dmd, log, counters, repairs)
                 except Exception as e:
                     log.critical("%s: %s on %s '%s' of %s", type(e).__name__, e, "relationship", name, path_string)
                 else:
                     # No exception, so it should be safe to add this child node as a traversable object.
-                    nodes.append(childnode)
+                    paths.acquire(node_id)
+                    nodes.append(_frontierEntry(childnode, node_id, name))
 
+        nodes.close()
+        repairs.commit()
         if not use_unlimited_memory:
             transaction.abort()
 
@@ -433,6 +561,105 @@ def findPOSKeyErrors(topnode, attempt_fix, use_unlimited_memory, dmd, log, count
                   current_cycle, counters['item_count'].value(), counters['error_count'].value(), counters['repair_count'].value())
 
 
+# Per-process state of a --workers subtree worker, holding its own ZenScriptBase connection
+_worker = {}
+
+
+def _init_worker(options, log, log_queue):
+    _worker['options'] = options
+    _worker['log'] = log
+    _worker['dmd'] = ZenToolboxUtils.init_worker(log, log_queue)
+
+
+def _scan_subtree(path):
+    """ Scans one subtree in a worker process, returning (path, items, errors, repairs) """
+    options, log, dmd = _worker['options'], _worker['log'], _worker['dmd']
+    counters = {
+        'item_count': ZenToolboxUtils.Counter(0),
+        'error_count': ZenToolboxUtils.Counter(0),
+        'repair_count': ZenToolboxUtils.Counter(0)
+        }
+    try:
+        node = dmd.getObjByPath(path)
+    except _RELEVANT_EXCEPTIONS as e:
+        log.critical("%s: %s %s '%s'", type(e).__name__, e, "while retreiving", "/".join(path))
+        return path, 1, 1, 0
+    findPOSKeyErrors(node, options['fix'], options['unlimitedram'], dmd, log, counters,
+                     options['cycles'], options['tmpdir'], options['queue_size'],
+                     commit_batch=options['commit_batch'])
+    transaction.abort()
+    return path, counters['item_count'].value(), counters['error_count'].value(), counters['repair_count'].value()
+
+
+def scan_subtrees(subtrees, cli_options, log, counters):
+    """ Scans the subtrees below --split-depth across --workers processes, adding their results to counters """
+    print
+    log.info("Scanning %d subtrees with %d workers", len(subtrees), cli_options['workers'])
+    listener = ZenToolboxUtils.WorkerLogListener(log)
+    pool = multiprocessing.Pool(cli_options['workers'], _init_worker, (cli_options, log, listener.queue))
+    try:
+        for done, (path, items, errors, repairs) in enumerate(pool.imap_unordered(_scan_subtree, subtrees), 1):
+            log.debug("Subtree %s: examined %d objects, encountered %d errors, and attempted %d repairs",
+                      "/".join(path), items, errors, repairs)
+            counters['item_count'].add(items)
+            counters['error_count'].add(errors)
+            counters['repair_count'].add(repairs)
+            inline_print("[%s]  Subtrees %d/%d | Items Scanned: %12d | Errors:  %6d | Repairs: %6d |  " %
+                         (time.strftime("%Y-%m-%d %H:%M:%S"), done, len(subtrees), counters['item_count'].value(),
+                          counters['error_count'].value(), counters['repair_count'].value()))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        listener.stop()
+    log.info("findposkeyerror subtrees: examined %d objects, encountered %d errors, and attempted %d repairs in total",
+             counters['item_count'].value(), counters['error_count'].value(), counters['repair_count'].value())
+
+
+def scan_dangling_parents(folder, cli_options, dmd, log, counters):
+    """
+    Prepass mode: zodbscan's table scan finds the dangling references without activating
+    any object, then only the Zope objects holding them (and their direct children) under
+    folder are traversed, so the usual fixers apply.
+    """
+    print("[%s] Locating dangling references in object_state:" % (strftime("%Y-%m-%d %H:%M:%S", localtime())))
+    # OID bitmaps stay in RAM; only the reference graph goes to --tmpdir
+    reporter = PKEReporter(getGlobalConfiguration().get("zodb-db", "zodb"))
+    located = reporter.dangling_paths(log, cli_options['batchsize'], cli_options['workers'], cli_options['tmpdir'])
+    if located is None:
+        counters['error_count'].increment()
+        return
+    prefix = folder.getPhysicalPath()
+    prefix = prefix if prefix != ('',) else ()
+    paths = sorted(set(path for path, parent_zoid, zoid in located if path[:len(prefix)] == prefix))
+    for path, parent_zoid, zoid in located:
+        log.info("Missing 0x%08x referenced by 0x%08x, found under %s", zoid, parent_zoid, "/".join(path) or "/")
+    print("[%s] %d dangling references, %d paths to examine under '%s'" %
+          (strftime("%Y-%m-%d %H:%M:%S", localtime()), len(located), len(paths), cli_options['path']))
+    log.info("Prepass found %d dangling references, examining %d paths", len(located), len(paths))
+
+    for path in paths:
+        path_counters = {
+            'item_count': ZenToolboxUtils.Counter(0),
+            'error_count': ZenToolboxUtils.Counter(0),
+            'repair_count': ZenToolboxUtils.Counter(0)
+            }
+        try:
+            node = dmd.getObjByPath(path)
+        except _RELEVANT_EXCEPTIONS as e:
+            log.critical("%s: %s %s '%s'", type(e).__name__, e, "while retreiving", "/".join(path))
+            counters['error_count'].increment()
+            continue
+        # Errors surface while visiting the holder or one of its direct children
+        findPOSKeyErrors(node, cli_options['fix'], cli_options['unlimitedram'], dmd, log, path_counters,
+                         cli_options['cycles'], cli_options['tmpdir'], cli_options['queue_size'],
+                         len(path) + 1, [], cli_options['commit_batch'])
+        for name in counters:
+            counters[name].add(path_counters[name].value())
+
+
 def main():
     """ Scans through zodb hierarchy (from user-supplied path, defaults to /,  checking for PKEs """
 
@@ -448,6 +675,18 @@ def main():
                         help="base path to scan from (Devices.Server)?")
     parser.add_argument("-u", "--unlimitedram", action="store_true", default=False,
                         help="skip transaction.abort() - unbounded RAM, ~40%% faster")
+    parser.add_argument("-q", "--queue-size", action="store", default=100000, type=int,
+                        help="traversal frontier entries kept in RAM before spilling to --tmpdir")
+    parser.add_argument("-w", "--workers", action="store", default=1, type=int,
+                        help="scan the subtrees below --split-depth in N parallel worker processes")
+    parser.add_argument("-d", "--split-depth", action="store", default=4, type=int,
+                        help="path depth handed to --workers (4 splits /zport/dmd/Devices into device classes)")
+    parser.add_argument("-c", "--commit-batch", action="store", default=100, type=int,
+                        help="repairs grouped per transaction (with --fix), retried on ConflictError")
+    parser.add_argument("-P", "--prepass", action="store_true", default=False,
+                        help="locate dangling references with a raw object_state scan, then traverse only their holders")
+    parser.add_argument("-b", "--batchsize", action="store", default=10000, type=int,
+                        help="object_state rows per query of the --prepass scan")
     cli_options = vars(parser.parse_args())
     log, logFileName = ZenToolboxUtils.configure_logging(scriptName, scriptVersion, cli_options['tmpdir'])
     log.info("Command line options: %s" % (cli_options))
@@ -484,7 +723,22 @@ def main():
         print("[%s] Examining items under the '%s' path (%s):" %
               (strftime("%Y-%m-%d %H:%M:%S", localtime()), cli_options['path'], folder))
         log.info("Examining items under the '%s' path (%s)", cli_options['path'], folder)
-        findPOSKeyErrors(folder, cli_options['fix'], cli_options['unlimitedram'], dmd, log, counters, cli_options['cycles'])
+        if cli_options['prepass']:
+            scan_dangling_parents(folder, cli_options, dmd, log, counters)
+        elif cli_options['workers'] > 1:
+            # The coordinator scans above the split depth, the workers scan each subtree below it
+            subtrees = []
+            split_depth = max(cli_options['split_depth'], len(folder.getPhysicalPath()))
+            findPOSKeyErrors(folder, cli_options['fix'], cli_options['unlimitedram'], dmd, log, counters,
+                             cli_options['cycles'], cli_options['tmpdir'], cli_options['queue_size'],
+                             split_depth, subtrees, cli_options['commit_batch'])
+            transaction.abort()
+            if subtrees:
+                scan_subtrees(subtrees, cli_options, log, counters)
+        else:
+            findPOSKeyErrors(folder, cli_options['fix'], cli_options['unlimitedram'], dmd, log, counters,
+                             cli_options['cycles'], cli_options['tmpdir'], cli_options['queue_size'],
+                             commit_batch=cli_options['commit_batch'])
         print
 
     print("\n[%s] Execution finished in %s\n" %
@@ -17,6 +17,7 @@ import argparse
 import datetime
 import Globals
 import logging
+import multiprocessing
 import os
 import sys
 import time
@@ -25,6 +26,10 @@ import transaction
 import ZenToolboxUtils
 
 from Products.CMFCore.utils import getToolByName
+from Products.ZenModel.Device import Device
+from Products.ZenModel.ZenModelRM import ZenModelRM
+from Products.ZenRelations.RelationshipManager import RelationshipManager
+from Products.ZenRelations.ToManyContRelationship import ToManyContRelationship
 from Products.ZenUtils.Utils import getAllConfmonObjects
 from Products.ZenUtils.ZenScriptBase import ZenScriptBase
 from Products.Zuul.catalog.events import IndexingEvent
@@ -43,8 +48,159 @@ def progress_bar(items, errors, repairs, fix_value):
         inline_print("[%s]  | Items Scanned: %12d | Errors:  %6d |  " % (time.strftime("%Y-%m-%d %H:%M:%S"), items, errors))
 
 
-def scan_relationships(attempt_fix, max_cycles, use_unlimited_memory, dmd, log, counters):
-    '''Scan through zodb relationships looking for broken references'''
+def check_object(object, attempt_fix, log, counters, repairs):
+    '''Runs checkRelations on one confmon object, adding any repair to the repairs TransactionBatch'''
+    changed = False
+    try:
+        object.checkRelations(repair=attempt_fix)
+        changed = object._p_changed
+        if not changed:
+            object._p_deactivate()
+        log.debug("Checked object %s" % (object.getPrimaryDmdId()))
+    except Exception as e:
+        log.exception(e)
+        counters['error_count'].increment()
+        counters['repair_count'].increment()
+    except:
+        try:
+            log.error("Object %s had broken relationship" % (object.getPrimaryDmdId()))
+        except:
+            log.error("Object had issues loading - PKE")
+        counters['error_count'].increment()
+        counters['repair_count'].increment()
+    # Outside the try: adding may commit the batch, whose failures are not this object's
+    if changed:
+        repairs.add(lambda: object.checkRelations(repair=True), applied=True)
+
+
+# Worker process state: dmd connection, repairs batch and scan arguments
+_worker = {}
+CHUNK_SIZE = 1000   # confmon objects above the split depth handed to a worker at a time
+
+
+def _init_worker(attempt_fix, use_unlimited_memory, log, counters, commit_batch, commit_interval, log_queue):
+    _worker['dmd'] = ZenToolboxUtils.init_worker(log, log_queue)
+    _worker['repairs'] = ZenToolboxUtils.TransactionBatch(log, commit_batch, commit_interval)
+    _worker['args'] = (attempt_fix, use_unlimited_memory, log, counters)
+
+
+def _check_chunk(oids):
+    '''Checks the confmon objects of one chunk of oids in a worker (counters are shared with the coordinator)'''
+    attempt_fix, use_unlimited_memory, log, counters = _worker['args']
+    repairs = _worker['repairs']
+    connection = _worker['dmd']._p_jar
+    for oid in oids:
+        counters['item_count'].increment()
+        try:
+            object = connection[oid].primaryAq()
+        except Exception as e:
+            log.error("Unable to load object 0x%s: %s: %s", oid.encode('hex'), type(e).__name__, e)
+            counters['error_count'].increment()
+            continue
+        check_object(object, attempt_fix, log, counters, repairs)
+    repairs.commit()
+    if not use_unlimited_memory:
+        transaction.abort()
+
+
+def _check_subtree(task):
+    '''
+    Checks, in a worker, the confmon objects of the subtree rooted at an oid (its root
+    included) as getAllConfmonObjects() would have reached them from the parent whose
+    primary id is given (counters are shared with the coordinator)
+    '''
+    PROGRESS_INTERVAL = 829  # Prime number near 1000 ending in a 9, used for progress bar
+
+    oid, parent_id = task
+    attempt_fix, use_unlimited_memory, log, counters = _worker['args']
+    repairs = _worker['repairs']
+    try:
+        root = _worker['dmd']._p_jar[oid].primaryAq()
+        # getAllConfmonObjects() skips objects held by non-containing relationships
+        if isinstance(root, RelationshipManager) and not root.getPrimaryDmdId().startswith(parent_id):
+            return
+        objects = getAllConfmonObjects(root)
+        if isinstance(root, ZenModelRM):
+            counters['item_count'].increment()
+            check_object(root, attempt_fix, log, counters, repairs)
+        for checked, object in enumerate(objects, 1):
+            counters['item_count'].increment()
+            check_object(object, attempt_fix, log, counters, repairs)
+            if (checked % PROGRESS_INTERVAL) == 0 and not use_unlimited_memory:
+                repairs.commit()
+                transaction.abort()
+    except Exception as e:
+        log.error("Unable to walk the subtree of 0x%s: %s: %s", oid.encode('hex'), type(e).__name__, e)
+        counters['error_count'].increment()
+    repairs.commit()
+    if not use_unlimited_memory:
+        transaction.abort()
+
+
+def split_confmon_objects(base, split_depth, depth=1):
+    '''
+    Walks the top split_depth levels below base the way getAllConfmonObjects(base) does,
+    yielding (_check_chunk, oid) for the confmon objects found there and (_check_subtree,
+    (oid, primary id of its parent)) for every Device and every object at split_depth that
+    getAllConfmonObjects() would descend into.  Only the oids of those subtree roots are
+    read: the subtrees are loaded by the workers walking them, never by the coordinator.
+    '''
+    base_id = base.getPrimaryDmdId()
+    for obj in base.objectValues():
+        descend = isinstance(obj, (ZenModelRM, ToManyContRelationship))
+        if descend and (depth == split_depth or isinstance(obj, Device)):
+            yield _check_subtree, (obj._p_oid, base_id)
+            continue
+        if isinstance(obj, RelationshipManager) and not obj.getPrimaryDmdId().startswith(base_id):
+            continue
+        if isinstance(obj, ZenModelRM) and obj.id != "dmd":
+            yield _check_chunk, obj._p_oid
+        if descend:
+            for work in split_confmon_objects(obj, split_depth, depth + 1):
+                yield work
+
+
+def dispatch_relationships(pool, attempt_fix, use_unlimited_memory, dmd, log, counters, split_depth):
+    '''
+    Hands the confmon objects to the worker pool: those of the top split_depth levels by
+    oid, CHUNK_SIZE at a time, and the subtrees below (and every device) whole, one task
+    each, so that the workers enumerate and load their own objects.  Waits for every task.
+    '''
+    results = []
+    chunk = []
+    subtrees = 0
+    for func, work in split_confmon_objects(dmd, split_depth):
+        if func is _check_subtree:
+            results.append(pool.apply_async(_check_subtree, (work,)))
+            subtrees += 1
+            continue
+        chunk.append(work)
+        if len(chunk) == CHUNK_SIZE:
+            results.append(pool.apply_async(_check_chunk, (chunk,)))
+            chunk = []
+    if chunk:
+        results.append(pool.apply_async(_check_chunk, (chunk,)))
+    if not use_unlimited_memory:
+        transaction.abort()
+    log.info("Dispatched %d subtrees and %d chunks of confmon objects to the workers",
+             subtrees, len(results) - subtrees)
+
+    for result in results:
+        while not result.ready():
+            result.wait(1)
+            progress_bar(counters['item_count'].value(), counters['error_count'].value(),
+                         counters['repair_count'].value(), attempt_fix)
+        result.get()
+
+
+def scan_relationships(attempt_fix, max_cycles, use_unlimited_memory, dmd, log, counters, workers=1,
+                       commit_batch=100, commit_interval=30, split_depth=4):
+    '''
+    Scan through zodb relationships looking for broken references.  Repairs are savepointed
+    and committed every commit_batch objects or commit_interval seconds, retried on conflicts;
+    pending repairs are also committed before every periodic transaction.abort().  With
+    workers > 1 the subtrees below split_depth levels (and every device) are walked by workers.
+    '''
 
 #    ENTIRETY OF REBUILD CODE FROM ZenUtils/CheckRelations.py (for reference)
 #    def rebuild(self):
@@ -80,12 +236,34 @@ def scan_relationships(attempt_fix, max_cycles, use_unlimited_memory, dmd, log,
     progress_bar(counters['item_count'].value(), counters['error_count'].value(),
                          counters['repair_count'].value(), attempt_fix)
 
+    pool = None
+    if workers > 1:
+        log.info("Checking relations in %d worker processes", workers)
+        listener = ZenToolboxUtils.WorkerLogListener(log)
+        pool = multiprocessing.Pool(workers, _init_worker, (attempt_fix, use_unlimited_memory, log, counters,
+                                                            commit_batch, commit_interval, listener.queue))
+    repairs = ZenToolboxUtils.TransactionBatch(log, commit_batch, commit_interval)
+
     while ((current_cycle < max_cycles) and (number_of_issues != 0)):
         number_of_issues = 0
         current_cycle += 1
         if (attempt_fix):
             log.info("Beginning cycle %d" % (current_cycle))
 
+        if pool is not None:
+            try:
+                dispatch_relationships(pool, attempt_fix, use_unlimited_memory, dmd, log, counters, split_depth)
+            except Exception as e:
+                log.exception(e)
+                pool.terminate()
+                pool.join()
+                listener.stop()
+                print("\n\n#################################################################")
+                print "CRITICAL: Exception encountered - aborting.  Please see log file."
+                print("#################################################################")
+                return
+            continue
+
         try:
             relationships_to_check = getAllConfmonObjects(dmd)
         except Exception:
@@ -98,35 +276,19 @@ def scan_relationships(attempt_fix, max_cycles, use_unlimited_memory, dmd, log,
 
                 if (counters['item_count'].value() % PROGRESS_INTERVAL) == 0:
                     if not use_unlimited_memory:
+                        repairs.commit()
                         transaction.abort()
                     progress_bar(counters['item_count'].value(), counters['error_count'].value(),
                                  counters['repair_count'].value(), attempt_fix)
                     log.debug("Processed %d items" % (counters['item_count'].value()))
 
-                try:
-                    object.checkRelations(repair=attempt_fix)
-                    changed = object._p_changed
-                    if not changed:
-                        object._p_deactivate()
-                    else:
-                        transaction.commit()
-                    log.debug("Checked object %s" % (object.getPrimaryDmdId()))
-                except Exception as e:
-                    log.exception(e)
-                    counters['error_count'].increment()
-                    counters['repair_count'].increment()
-                except:
-                    try:
-                        log.error("Object %s had broken relationship" % (object.getPrimaryDmdId()))
-                    except:
-                        log.error("Object had issues loading - PKE")
-                    counters['error_count'].increment()
-                    counters['repair_count'].increment()
+                check_object(object, attempt_fix, log, counters, repairs)
 
             except StopIteration:
                 break
             except Exception as e:
                 log.exception(e)
+                repairs.commit()
                 if not use_unlimited_memory:
                     transaction.abort()
                 progress_bar(counters['item_count'].value(), counters['error_count'].value(),
@@ -135,7 +297,12 @@ def scan_relationships(attempt_fix, max_cycles, use_unlimited_memory, dmd, log,
                 print "CRITICAL: Exception encountered - aborting.  Please see log file."
                 print("#################################################################")
                 return
+        repairs.commit()
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+        listener.stop()
     if not use_unlimited_memory:
         transaction.abort()
     progress_bar(counters['item_count'].value(), counters['error_count'].value(),
@@ -156,6 +323,15 @@ def main():
                         help="maximum times to cycle (with --fix)")
     parser.add_argument("-u", "--unlimitedram", action="store_true", default=False,
                         help="skip transaction.abort() - unbounded RAM, ~40%% faster")
+    parser.add_argument("-w", "--workers", action="store", default=1, type=int,
+                        help="check relations in N parallel worker processes")
+    parser.add_argument("-c", "--commit-batch", action="store", default=100, type=int,
+                        help="repaired objects grouped per transaction (with --fix), retried on ConflictError")
+    parser.add_argument("-i", "--commit-interval", action="store", default=30, type=int,
+                        help="commit pending repairs at least every N seconds (with --fix)")
+    parser.add_argument("-d", "--split-depth", action="store", default=4, type=int,
+                        help="levels below dmd enumerated by the coordinator with --workers; the subtrees "
+                             "below, and every device, are enumerated and checked by a worker")
     cli_options = vars(parser.parse_args())
     log, logFileName = ZenToolboxUtils.configure_logging(scriptName, scriptVersion, cli_options['tmpdir'])
     log.info("Command line options: %s" % (cli_options))
@@ -179,7 +355,9 @@ def main():
         'repair_count': ZenToolboxUtils.Counter(0)
         }
 
-    scan_relationships(cli_options['fix'], cli_options['cycles'], cli_options['unlimitedram'], dmd, log, counters)
+    scan_relationships(cli_options['fix'], cli_options['cycles'], cli_options['unlimitedram'], dmd, log, counters,
+                       cli_options['workers'], cli_options['commit_batch'], cli_options['commit_interval'],
+                       cli_options['split_depth'])
 
     if not cli_options['skipEvents']:
         if counters['error_count'].value():
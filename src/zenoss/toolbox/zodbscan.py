@@ -16,35 +16,60 @@ documentationURL = "https://support.zenoss.com/hc/en-us/articles/203118175"
 import argparse
 import cPickle
 import cStringIO
+import csv
 import datetime
 import Globals
+import json
 import logging
+import mmap
+import multiprocessing
 import os
+import pickletools
+import shutil
+import struct
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import transaction
 import ZConfig
 import ZenToolboxUtils
 
+from array import array
 from collections import deque
+from multiprocessing.pool import ThreadPool
 from pickle import Unpickler as UnpicklerBase
+from Products.ZenModel.Device import Device
+from Products.ZenModel.DeviceClass import DeviceClass
 from Products.ZenRelations.RelationshipBase import RelationshipBase
 from Products.ZenRelations.ToManyContRelationship import ToManyContRelationship
+from Products.ZenRelations.ToManyRelationship import ToManyRelationship
+from Products.ZenRelations.ToOneRelationship import ToOneRelationship
 from Products.ZenUtils.AutoGCObjectReader import gc_cache_every
 from Products.ZenUtils.GlobalConfig import getGlobalConfiguration
 from Products.ZenUtils.ZenScriptBase import ZenScriptBase
+from persistent.TimeStamp import TimeStamp
 from relstorage.zodbpack import schema_xml
 from time import localtime, strftime
-from ZenToolboxUtils import inline_print
+from ZenObjectStateDump import ObjectStateDump
+from ZenRefGraph import iter_part, RefGraph, RefGraphPart, write_refgraph, ZOID_TYPECODE
+from ZenToolboxUtils import inline_print, LRUCache
 from ZODB.DB import DB
 from ZODB.POSException import POSKeyError
 from ZODB.transact import transact
-from ZODB.utils import u64
+from ZODB.utils import p64, u64
 
 schema = ZConfig.loadSchemaFile(cStringIO.StringIO(schema_xml))
 
+# Disk used by the table engine's edge parts: 16 bytes per object plus 8 per reference,
+# with room for a few references per object
+REFS_BYTES_PER_OBJECT = 64
+# Peak disk used next to an --export-refs file while write_refgraph merges the parts (which
+# still exist): its temporary source, offset and target files plus the forward and reverse graph
+REFGRAPH_BYTES_PER_OBJECT = 3*REFS_BYTES_PER_OBJECT
+DEFAULT_CHECKPOINT_MINUTES = 5
+
 
 class Analyzer(UnpicklerBase):
     """ Able to analyze an object's pickle to try to figure out the name/class of the problem oid.  """
@@ -65,20 +90,873 @@ class Analyzer(UnpicklerBase):
 
 
 def get_refs(p):
-    """ Generator-using version of ZODB.serialize.references """
+    """
+    Returns the persistent references of a record (class pickle + state pickle), as
+    ZODB.serialize.references does, cross-database references included
+    """
     refs = []
     u = cPickle.Unpickler(cStringIO.StringIO(p))
     u.persistent_load = refs
     u.noload()
     u.noload()
-    for ref in refs:
-        if isinstance(ref, tuple):
-            yield ref[0]
-        elif isinstance(ref, str):
-            yield ref
+    return [ref if type(ref) is str else ref[0] if type(ref) is tuple else ref[1][:2] for ref in refs]
+
+
+def get_local_refs(p):
+    """ Returns the set of zoids a record references within its own database """
+    # Cross-database references (not strings) are not held in this database
+    return set(u64(ref) for ref in set(get_refs(p)) if type(ref) is str)
+
+
+def allocate_buffer(size, tmpdir=None):
+    """ Returns a zero-filled writable buffer: a bytearray, or an mmap'ed temporary file under tmpdir """
+    if tmpdir is None:
+        return bytearray(size)
+    with tempfile.TemporaryFile(dir=tmpdir) as backing:
+        backing.truncate(size)
+        return mmap.mmap(backing.fileno(), size)
+
+
+def grow_buffer(buf, size, tmpdir=None):
+    """ Returns a copy of buf extended to at least size bytes (at least doubling it), releasing buf """
+    grown = allocate_buffer(max(2*len(buf), size), tmpdir)
+    grown[:len(buf)] = str(buf[:])
+    if isinstance(buf, mmap.mmap):
+        buf.close()
+    return grown
+
+
+class OidSet(object):
+    """
+    Compact membership set of u64 zoids - one bit per zoid, held in a bytearray or, when
+    tmpdir is given, in an mmap'ed temporary file under tmpdir.  Grows as larger zoids are added.
+    """
+    def __init__(self, max_zoid=0, tmpdir=None):
+        self._tmpdir = tmpdir
+        self._count = 0
+        self._setbuffer(allocate_buffer((max_zoid >> 3) + 1, tmpdir))
+
+    @classmethod
+    def frombuffer(cls, bits, count, tmpdir=None):
+        oidset = cls(0, tmpdir)
+        oidset._setbuffer(bits)
+        oidset._count = count
+        return oidset
+
+    def _setbuffer(self, bits):
+        self._bits = bits
+        self._mapped = isinstance(bits, mmap.mmap)    # mmap items are 1-char strings, not ints
+
+    def getbuffer(self):
+        return self._bits
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, zoid):
+        index = zoid >> 3
+        if index >= len(self._bits):
+            return False
+        value = self._bits[index]
+        if self._mapped:
+            value = ord(value)
+        return bool(value & (1 << (zoid & 7)))
+
+    def add(self, zoid):
+        """ Adds zoid, returning True if it was not already a member """
+        index = zoid >> 3
+        if index >= len(self._bits):
+            self._setbuffer(grow_buffer(self._bits, index + 1, self._tmpdir))
+        value = self._bits[index]
+        if self._mapped:
+            value = ord(value)
+        bit = 1 << (zoid & 7)
+        if value & bit:
+            return False
+        self._bits[index] = chr(value | bit) if self._mapped else (value | bit)
+        self._count += 1
+        return True
+
+    def update(self, zoids):
+        for zoid in zoids:
+            self.add(zoid)
+
+    def merge(self, offset, bits, count):
+        """
+        Adds the count members of bits, a string of bitmap bytes starting at byte offset,
+        in bulk.  Only its first and last bytes may hold members already; the bytes in
+        between are copied over.
+        """
+        end = offset + len(bits)
+        if end > len(self._bits):
+            self._setbuffer(grow_buffer(self._bits, end, self._tmpdir))
+        for index in set((offset, end - 1)):
+            value = self._bits[index]
+            if self._mapped:
+                value = ord(value)
+            value |= ord(bits[index - offset])
+            self._bits[index] = chr(value) if self._mapped else value
+        if len(bits) > 2:
+            self._bits[offset + 1:end - 1] = bits[1:-1]
+        self._count += count
+
+
+class ParentTable(object):
+    """
+    Records one parent zoid per discovered zoid (8 bytes per zoid) so that the ancestor
+    chain of an object can be rebuilt on demand instead of carried along the traversal.
+    """
+    _entry = struct.Struct('<Q')
+
+    def __init__(self, max_zoid=0, tmpdir=None):
+        self._tmpdir = tmpdir
+        self._table = allocate_buffer(self._entry.size * (max_zoid + 1), tmpdir)
+
+    @classmethod
+    def frombuffer(cls, table, tmpdir=None):
+        parents = cls(0, tmpdir)
+        parents._table = table
+        return parents
+
+    def getbuffer(self):
+        return self._table
+
+    def get(self, zoid):
+        """ Returns the parent zoid recorded for zoid, or None """
+        offset = self._entry.size * zoid
+        if offset >= len(self._table):
+            return None
+        parent, = self._entry.unpack_from(self._table, offset)
+        return parent - 1 if parent else None     # stored as parent + 1, 0 means unset
+
+    def setdefault(self, zoid, parent):
+        """ Records parent for zoid unless zoid already has one """
+        offset = self._entry.size * zoid
+        if offset >= len(self._table):
+            self._table = grow_buffer(self._table, offset + self._entry.size, self._tmpdir)
+        elif self._entry.unpack_from(self._table, offset)[0]:
+            return
+        self._entry.pack_into(self._table, offset, parent + 1)
+
+    def ancestors(self, zoid):
+        """ Returns the oids from the traversal root down to (and including) zoid """
+        chain = [zoid]
+        parent = self.get(zoid)
+        while parent is not None:
+            chain.append(parent)
+            parent = self.get(parent)
+        return tuple(p64(z) for z in reversed(chain))
+
+
+class Checkpoint(object):
+    """
+    Scan state saved to a file under --tmpdir: a pickled dict of small values followed by
+    named raw buffers (OID bitmaps, parent table, packed zoid arrays).  Written to a
+    temporary name and renamed into place, so an interrupted write keeps the previous one.
+    """
+    MAGIC = 'ZODBSCAN-CKPT-1\n'
+    CHUNK = 16*1024*1024
+    _header = struct.Struct('<16sQ')
+
+    def __init__(self, filename, interval, tmpdir=None):
+        self.filename = filename
+        self._interval = interval
+        self._tmpdir = tmpdir
+        self._last = time.time()
+
+    def due(self):
+        return self._interval > 0 and (time.time() - self._last) >= self._interval
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def write(self, meta, buffers):
+        partial = self.filename + '.partial'
+        with open(partial, 'wb') as f:
+            f.write(self.MAGIC)
+            sections = [('meta', cPickle.dumps(meta, cPickle.HIGHEST_PROTOCOL))] + sorted(buffers.items())
+            for name, data in sections:
+                f.write(self._header.pack(name, len(data)))
+                for offset in xrange(0, len(data), self.CHUNK):
+                    f.write(data[offset:offset + self.CHUNK])
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(partial, self.filename)
+        self._last = time.time()
+
+    def read(self):
+        """ Returns (meta, {name: buffer}); buffers are allocated like the scan's own (RAM or mmap) """
+        buffers = {}
+        with open(self.filename, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError("%s is not a zodbscan checkpoint" % (self.filename))
+            header = f.read(self._header.size)
+            while header:
+                name, length = self._header.unpack(header)
+                data = allocate_buffer(length, self._tmpdir if length >= self.CHUNK else None)
+                for offset in xrange(0, length, self.CHUNK):
+                    chunk = f.read(min(self.CHUNK, length - offset))
+                    data[offset:offset + len(chunk)] = chunk    # str, accepted by bytearray and mmap
+                buffers[name.rstrip('\0')] = data
+                header = f.read(self._header.size)
+        return cPickle.loads(str(buffers.pop('meta')[:])), buffers
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.filename)
+
+
+def iter_object_state(connmanager, columns, batch_size, lower=-1, upper=None):
+    """ Streams rows of object_state in zoid order, one zoid range batch at a time """
+    stmt = "SELECT %s FROM object_state WHERE zoid > %%s" % (columns)
+    if upper is not None:
+        stmt += " AND zoid <= %d" % (upper)
+    stmt += " ORDER BY zoid LIMIT %s"
+    conn, cursor = connmanager.open()
+    try:
+        while True:
+            cursor.execute(stmt, (lower, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+            lower = rows[-1][0]
+    finally:
+        connmanager.close(conn, cursor)
+
+
+def load_object_state(connmanager, columns, zoids, batch_size):
+    """ Fetches the object_state rows of the given zoids with batched 'WHERE zoid IN (...)' queries """
+    conn, cursor = connmanager.open()
+    try:
+        for row in select_object_state(cursor, columns, zoids, batch_size):
+            yield row
+    finally:
+        connmanager.close(conn, cursor)
+
+
+def select_object_state(cursor, columns, zoids, batch_size):
+    """ load_object_state() on an already open cursor """
+    zoids = list(zoids)
+    for start in xrange(0, len(zoids), batch_size):
+        batch = ','.join('%d' % zoid for zoid in zoids[start:start + batch_size])
+        cursor.execute("SELECT %s FROM object_state WHERE zoid IN (%s)" % (columns, batch))
+        for row in cursor.fetchall():
+            yield row
+
+
+class Prefetcher(object):
+    """
+    Pipelined loading for the graph engine: batches of the next unseen oids are popped off
+    the frontier and their states fetched with bulk 'WHERE zoid IN (...)' queries on a pool
+    of loader threads, several batches ahead, so MySQL round trips overlap the reference
+    extraction of the batch being processed.  Each loader thread keeps its own MySQL
+    connection, opened on its first batch and closed by close().
+    """
+    def __init__(self, connmanager, batch_size, threads=1):
+        self._connmanager = connmanager
+        self._batch_size = batch_size
+        self._depth = threads + 1
+        self._pool = ThreadPool(threads)
+        self._pending = deque()     # (oids, AsyncResult) in submission order
+        self._inflight = set()
+        self._local = threading.local()
+        self._connections = []      # (conn, cursor) of every loader thread
+        self._lock = threading.Lock()
+
+    def _load(self, zoids):
+        if getattr(self._local, 'cursor', None) is None:
+            conn, cursor = self._connmanager.open()
+            with self._lock:
+                self._connections.append((conn, cursor))
+            self._local.conn, self._local.cursor = conn, cursor
+        try:
+            return dict(select_object_state(self._local.cursor, "zoid, state", zoids, len(zoids)))
+        except Exception:
+            # The next batch of this thread reconnects
+            self._close(self._local.conn, self._local.cursor)
+            self._local.conn = self._local.cursor = None
+            raise
+
+    def _close(self, conn, cursor):
+        with self._lock:
+            if (conn, cursor) not in self._connections:
+                return
+            self._connections.remove((conn, cursor))
+        self._connmanager.close(conn, cursor)
+
+    def pending(self):
+        return bool(self._pending)
+
+    def queued(self):
+        """ Zoids popped off the frontier whose batches are not processed yet """
+        return list(self._inflight)
+
+    def fill(self, frontier, seen):
+        """ Submits batches of unseen oids popped from the right of frontier until enough are in flight """
+        while frontier and len(self._pending) < self._depth:
+            oids = []
+            while frontier and len(oids) < self._batch_size:
+                oid = frontier.pop()
+                zoid = u64(oid)
+                if zoid not in seen and zoid not in self._inflight:
+                    self._inflight.add(zoid)
+                    oids.append(oid)
+            if oids:
+                self._pending.append((oids, self._pool.apply_async(self._load, ([u64(o) for o in oids],))))
+
+    def next(self):
+        """ Returns [(oid, state or None if missing), ...] of the oldest batch, waiting for it if needed """
+        oids, result = self._pending.popleft()
+        states = result.get()
+        self._inflight.difference_update(u64(o) for o in oids)
+        return [(oid, states.get(u64(oid))) for oid in oids]
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        for conn, cursor in list(self._connections):
+            self._close(conn, cursor)
+
+
+def read_last_tid(filename):
+    """ Returns the tid recorded by the last --since-last-run scan, or None """
+    try:
+        with open(filename) as f:
+            return long(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def write_last_tid(filename, tid):
+    with open(filename + '.partial', 'w') as f:
+        f.write("%d\n" % (tid))
+    os.rename(filename + '.partial', filename)
+
+
+class TableRows(object):
+    """ Row source of the table engine: the object_state table of a live database, read by zoid range """
+    def __init__(self, connmanager, batch_size):
+        self._connmanager = connmanager
+        self.batch_size = batch_size
+
+    def max_zoid(self):
+        conn, cursor = self._connmanager.open()
+        try:
+            cursor.execute("SELECT max(zoid) from object_state")
+            return long(cursor.fetchone()[0] or 0)
+        finally:
+            self._connmanager.close(conn, cursor)
+
+    def slices(self, max_zoid, workers):
+        return zoid_slices(max_zoid, max(25, 4*workers))
+
+    def zoids(self, lower, upper):
+        for (zoid,) in iter_object_state(self._connmanager, "zoid", self.batch_size, lower, upper):
+            yield zoid
+
+    def states(self, lower, upper):
+        return iter_object_state(self._connmanager, "zoid, state", self.batch_size, lower, upper)
+
+    def existing(self, zoids):
+        """ Returns the zoids that exist now, to leave out objects created during the scan """
+        return set(row[0] for row in load_object_state(self._connmanager, "zoid", zoids, self.batch_size))
+
+
+class DumpRows(object):
+    """
+    Row source of the table engine reading an ObjectStateDump: a dump can only be read from
+    the start, so all zoids form a single slice, scanned in-process, and each pass reports
+    its progress through the dump file.
+    """
+    UPPER = (1 << 64) - 1
+    batch_size = None
+
+    def __init__(self, dump):
+        self._dump = dump
+
+    def max_zoid(self):
+        return 0    # unknown before the dump is read, the OidSet grows
+
+    def slices(self, max_zoid, workers):
+        return [(-1, self.UPPER)]
+
+    def _rows(self, label, start, lower, upper):
+        for scanned_count, (zoid, tid, state) in enumerate(self._dump, 1):
+            if (scanned_count % 10000) == 0:
+                progress_bar(label, start + int(25*self._dump.progress()), 0)
+            if lower < zoid <= upper:
+                yield zoid, state
+
+    def zoids(self, lower, upper):
+        for zoid, state in self._rows("Indexing", 0, lower, upper):
+            yield zoid
+
+    def states(self, lower, upper):
+        return self._rows("Scanning", 25, lower, upper)
+
+    def existing(self, zoids):
+        return set()    # a dump does not change while it is read
+
+
+# Per-process state for the table engine; a pool worker replaces the row source with its own
+_scan_worker = {}
+
+
+def _init_scan_worker(database, batch_size):
+    storage = get_config(database).storages[0].open()
+    _scan_worker['rows'] = TableRows(storage._adapter.connmanager, batch_size)
+
+
+def refgraph_part(export_dir, bounds):
+    """ Edge list file written for one zoid slice by --export-refs """
+    return os.path.join(export_dir, "%016x.part" % (bounds[1]))
+
+
+def zoid_slices(max_zoid, count):
+    """ Splits zoids 0..max_zoid into (lower, upper] ranges for iter_object_state """
+    step = (max_zoid // count) + 1
+    return [(lower - 1, min(lower + step - 1, max_zoid)) for lower in xrange(0, max_zoid + 1, step)]
+
+
+def map_slices(func, slices, database, batch_size, workers):
+    """
+    Applies func to every zoid slice, in-process or across a pool of worker processes each
+    reading object_state of database with its own connection
+    """
+    if workers <= 1:
+        for bounds in slices:
+            yield func(bounds)
+        return
+    pool = multiprocessing.Pool(workers, _init_scan_worker, (database, batch_size))
+    try:
+        for result in pool.imap_unordered(func, slices):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def index_zoid_slice(bounds):
+    """
+    Pass one: returns (bounds, byte offset, bitmap bytes, count) of the existing zoids of the
+    slice, for OidSet.merge
+    """
+    lower, upper = bounds
+    offset = (lower + 1) >> 3
+    bits = bytearray()
+    count = 0
+    for zoid in _scan_worker['rows'].zoids(lower, upper):
+        index = (zoid >> 3) - offset
+        if index >= len(bits):
+            bits.extend('\0' * (index + 1 - len(bits)))
+        bits[index] |= 1 << (zoid & 7)
+        count += 1
+    return bounds, offset, str(bits), count
+
+
+def check_zoid_slice(bounds):
+    """
+    Pass two: returns (bounds, [(parent zoid, missing zoid), ...], {class: [objects, bytes,
+    references]} or None) for the slice
+    """
+    lower, upper = bounds
+    existing = _scan_worker['existing']
+    export_dir = _scan_worker.get('export_dir')
+    part = RefGraphPart(refgraph_part(export_dir, bounds)) if export_dir else None
+    histogram = ClassHistogram() if _scan_worker.get('histogram') else None
+    dangling = []
+    for zoid, state in _scan_worker['rows'].states(lower, upper):
+        if not state:
+            continue
+        refs = get_local_refs(state)
+        for ref in refs:
+            if ref not in existing:
+                dangling.append((zoid, ref))
+        if part is not None and refs:
+            part.add(zoid, sorted(refs))
+        if histogram is not None:
+            histogram.add(state, len(refs))
+    if part is not None:
+        part.close()
+    return bounds, dangling, histogram and histogram.classes
+
+
+def sweep_reachable(parts, root_zoid, tmpdir=None, parents=None):
+    """
+    Counts the objects reachable from root_zoid through the edges of RefGraphPart files,
+    sweeping the parts in zoid order until a sweep reaches no new object.  Objects are
+    mostly created after the objects holding them, so a few sweeps are enough.  Given a
+    ParentTable, the object through which every zoid was first reached is recorded in it.
+    """
+    reached = OidSet(0, tmpdir)
+    reached.add(root_zoid)
+    grown = True
+    while grown:
+        grown = False
+        for part in parts:
+            for source, targets in iter_part(part):
+                if source in reached:
+                    for target in targets:
+                        if reached.add(target):
+                            grown = True
+                            if parents is not None:
+                                parents.setdefault(target, source)
+    return len(reached)
+
+
+def check_free_space(parts_dir, objects, log, export_refs=None):
+    """
+    Returns False (after saying so) if the filesystems of parts_dir and of the export_refs
+    file lack the room for the peak disk use of a table scan of objects
+    """
+    needs = [(parts_dir, REFS_BYTES_PER_OBJECT * objects)]
+    if export_refs:
+        needs.append((os.path.dirname(os.path.abspath(export_refs)), REFGRAPH_BYTES_PER_OBJECT * objects))
+    filesystems = {}    # device -> [directory, bytes needed]
+    for directory, needed in needs:
+        filesystems.setdefault(os.stat(directory).st_dev, [directory, 0])[1] += needed
+    for directory, needed in filesystems.itervalues():
+        stat = os.statvfs(directory)
+        available = stat.f_bavail * stat.f_frsize
+        if available < needed:
+            print("[%s] %s has %1.1f MB free, the reference scan of %d objects needs about %1.1f MB - "
+                  "use --tmpdir (or another --export-refs directory) to choose another filesystem\n" %
+                  (strftime("%Y-%m-%d %H:%M:%S", localtime()), directory, available/1048576.0, objects,
+                   needed/1048576.0))
+            log.error("%s has %d bytes free, the reference scan of %d objects needs about %d bytes",
+                      directory, available, objects, needed)
+            return False
+    return True
+
+
+def progress_bar(label, chunk_number, number_of_issues):
+    if number_of_issues > 1:
+        inline_print("[%s]  CRITICAL  [%-50s] %3d%% [%d Dangling References]" %
+                     (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number, number_of_issues))
+    elif number_of_issues == 1:
+        inline_print("[%s]  CRITICAL  [%-50s] %3d%% [%d Dangling Reference]" %
+                     (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number, number_of_issues))
+    else:
+        inline_print("[%s]  %s  [%-50s] %3d%% " % (time.strftime("%Y-%m-%d %H:%M:%S"), label, '='*chunk_number, 2*chunk_number))
+
+
+def progress_done(number_of_issues):
+    if number_of_issues > 0:
+        inline_print("[%s]  CRITICAL  [%-50s] %3.0d%% [%d Dangling References]\n" %
+                     (time.strftime("%Y-%m-%d %H:%M:%S"), '='*50, 100, number_of_issues))
+    else:
+        inline_print("[%s]  Verified  [%-50s] %3.0d%%\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), '='*50, 100))
+
+
+def warn_unreachable(database, reachable, total, log):
+    if total and (100.0*reachable/total) < 90.0:
+        print("  ** %3.2f%% of %s objects not reachable - examine your zenossdbpack settings **" %
+              ((100.0-100.0*reachable/total), database))
+        log.info("%3.2f%% of %s objects not reachable - examine your zenossdbpack settings" %
+                 ((100.0-100.0*reachable/total), database))
+
+
+def get_class_name(p):
+    """ Returns 'module.name' of the class in a record's first (class metadata) pickle, or None """
+    # Fast path: the class is almost always the first opcode, a GLOBAL after PROTO and MARKs
+    start = 2 if p[:1] == '\x80' else 0
+    while p[start:start + 1] == '(':
+        start += 1
+    if p[start:start + 1] == 'c':
+        module_end = p.find('\n', start)
+        name_end = p.find('\n', module_end + 1)
+        if module_end > 0 and name_end > 0:
+            return "%s.%s" % (p[start + 1:module_end], p[module_end + 1:name_end])
+    try:
+        for opcode, arg, pos in pickletools.genops(p):
+            if opcode.name == 'GLOBAL':
+                return arg.replace(' ', '.')
+            if opcode.name == 'STOP':
+                break
+    except Exception:
+        pass    # truncated or persistent class reference
+    return None
+
+
+def resolve_class(name):
+    """ Imports and returns the class named 'module.name', or None """
+    module, _, attr = name.rpartition('.')
+    try:
+        return getattr(__import__(module, fromlist=[attr]), attr)
+    except Exception:
+        return None
+
+
+def print_class_table(title, rows, top, log):
+    """ Prints and logs (class, objects, bytes) rows, largest byte count first """
+    rows = sorted(rows, key=lambda row: (-row[2], row[0]))
+    print("  %s" % (title))
+    print("  %12s  %12s  %s" % ("Objects", "MBytes", "Class"))
+    for klass, count, size in rows[:top]:
+        print("  %12d  %12.1f  %s" % (count, size/1048576.0, klass))
+    log.info(title)
+    for klass, count, size in rows:
+        log.info("  %d objects, %d bytes: %s", count, size, klass)
+
+
+class ClassHistogram(object):
+    """ Objects, pickle bytes and persistent references per class, collected during a scan """
+    def __init__(self, classes=None):
+        self.classes = classes or {}
+
+    def add(self, state, ref_count):
+        klass = get_class_name(state) or "(unknown)"
+        totals = self.classes.get(klass)
+        if totals is None:
+            totals = self.classes[klass] = [0, 0, 0]
+        totals[0] += 1
+        totals[1] += len(state)
+        totals[2] += ref_count
+
+    def update(self, classes):
+        for klass, (count, size, refs) in classes.iteritems():
+            totals = self.classes.setdefault(klass, [0, 0, 0])
+            totals[0] += count
+            totals[1] += size
+            totals[2] += refs
+
+    def rows(self):
+        """ (class, objects, bytes, references) rows, largest byte count first """
+        return sorted(((klass, count, size, refs) for klass, (count, size, refs) in self.classes.iteritems()),
+                      key=lambda row: (-row[2], row[0]))
+
+    def report(self, top, log, filename=None):
+        print_class_table("Objects by class:", [row[:3] for row in self.rows()], top, log)
+        if filename:
+            self.write(filename)
+            log.info("Class histogram written to %s", filename)
+
+    def write(self, filename):
+        """ Writes the histogram as JSON if filename ends in .json, as CSV otherwise """
+        fields = ("class", "objects", "bytes", "references")
+        with open(filename, 'wb') as f:
+            if filename.endswith('.json'):
+                json.dump([dict(zip(fields, row)) for row in self.rows()], f, indent=2)
+            else:
+                writer = csv.writer(f)
+                writer.writerow(fields)
+                writer.writerows(self.rows())
+
+
+class _Placeholder(object):
+    """ Stands in for every global while decoding structure pickles, so no class is imported """
+    def __new__(cls, *args, **kw):
+        return object.__new__(cls)
+
+    def __init__(self, *args, **kw):
+        pass
+
+    def __setstate__(self, state):
+        pass
+
+
+class _Reference(object):
+    """ Decoded persistent reference; zoid is None for cross-database references """
+    __slots__ = ('zoid',)
+
+    def __init__(self, ref):
+        oid = ref if type(ref) is str else ref[0] if type(ref) is tuple else None
+        self.zoid = u64(oid) if type(oid) is str else None
+
+
+def load_state(p):
+    """ Returns the decoded state pickle of a record, with placeholders for classes and references """
+    u = cPickle.Unpickler(cStringIO.StringIO(p))
+    u.find_global = lambda module, name: _Placeholder
+    u.persistent_load = _Reference
+    u.load()
+    return u.load()
+
+
+class StructureStats(object):
+    """
+    Shape of the BTrees and inline containers met during a scan.  Tree nodes record their
+    children and buckets their item count; trees are assembled from them at the end to
+    measure depth, fan-out and bucket fill.  Standalone buckets and sets, PersistentMapping
+    and PersistentList keep all their entries inline in a single pickle.
+    """
+    MAPPINGS = ("persistent.mapping.PersistentMapping", "ZODB.PersistentMapping.PersistentMapping",
+                "persistent.list.PersistentList", "ZODB.PersistentList.PersistentList")
+
+    def __init__(self):
+        self.nodes = {}         # tree zoid -> (class, [child zoids]), no children for single bucket trees
+        self.buckets = {}       # bucket, set or single bucket tree zoid -> (class, items)
+        self.inline = {}        # mapping/list zoid -> (class, entries, bytes)
+        self.sizes = {}         # tree, bucket and set zoid -> pickle bytes
+
+    @staticmethod
+    def classify(klass):
+        """ Returns ('BTree'|'TreeSet'|'Bucket'|'Set', max bucket size, max tree size) for BTrees classes """
+        module, _, name = klass.rpartition('.')
+        if not module.startswith('BTrees.') or not module.endswith('BTree'):
+            return None
+        prefix = module[len('BTrees.'):-len('BTree')]
+        kind = name[len(prefix):]
+        if not name.startswith(prefix) or kind not in ('BTree', 'TreeSet', 'Bucket', 'Set'):
+            return None
+        if prefix == 'fs':
+            return kind, 500, 500
+        # Buckets hold 30 items when keys and values are objects, 60 when either is, 120 otherwise
+        bucket_size = {2: 30, 1: 60, 0: 120}[prefix.count('O')]
+        return kind, bucket_size, 250 if prefix[0] == 'O' else 500
+
+    def add(self, zoid, p):
+        klass = get_class_name(p)
+        if not klass:
+            return
+        shape = self.classify(klass)
+        if shape is None and klass not in self.MAPPINGS:
+            return
+        try:
+            state = load_state(p)
+        except Exception:
+            return
+        if shape is None:
+            data = state.get('data', state.get('_container')) if isinstance(state, dict) else None
+            if data is not None:
+                self.inline[zoid] = (klass, len(data), len(p))
+            return
+        kind = shape[0]
+        self.sizes[zoid] = len(p)
+        if kind in ('Bucket', 'Set'):
+            items = len(state[0]) if state else 0
+            self.buckets[zoid] = (klass, items // 2 if kind == 'Bucket' else items)
+        elif state is None:
+            self.nodes[zoid] = (klass, [])
+        elif len(state) == 1:
+            # A tree holding a single bucket keeps that bucket's state inline: (((items...),),)
+            items = len(state[0][0][0])
+            self.nodes[zoid] = (klass, [])
+            self.buckets[zoid] = (klass, items // 2 if kind == 'BTree' else items)
         else:
-            assert isinstance(ref, list)
-            yield ref[1][:2]
+            self.nodes[zoid] = (klass, [child.zoid for child in state[0][0::2] if isinstance(child, _Reference)])
+
+    def _members(self):
+        members = set()
+        for klass, kids in self.nodes.itervalues():
+            members.update(kids)
+        return members
+
+    def trees(self):
+        """ Yields (zoid, class, depth, nodes, mean fan-out, buckets, mean bucket fill, items, bytes) per tree """
+        members = self._members()
+        for root, (klass, kids) in self.nodes.iteritems():
+            if root in members:
+                continue
+            max_bucket = self.classify(klass)[1]
+            depth = nodes = fanout = buckets = items = size = 0
+            fill = 0.0
+            level = [root]
+            while level:
+                depth += 1
+                below = []
+                for zoid in level:
+                    size += self.sizes.get(zoid, 0)
+                    kids = self.nodes.get(zoid, (None, None))[1]
+                    if kids:
+                        nodes += 1
+                        fanout += len(kids)
+                        below.extend(kids)
+                    elif zoid in self.buckets:
+                        buckets += 1
+                        count = self.buckets[zoid][1]
+                        items += count
+                        fill += min(1.0, float(count) / max_bucket)
+                level = below
+            yield (root, klass, depth, nodes, float(fanout) / nodes if nodes else 0.0,
+                   buckets, fill / buckets if buckets else 0.0, items, size)
+
+    def containers(self):
+        """ Yields (zoid, class, entries, bytes) for containers that keep their entries in one pickle """
+        members = self._members()
+        for zoid, (klass, items) in self.buckets.iteritems():
+            if zoid not in members and zoid not in self.nodes:
+                yield zoid, klass, items, self.sizes.get(zoid, 0)
+        for zoid, (klass, entries, size) in self.inline.iteritems():
+            yield zoid, klass, entries, size
+
+    def report(self, top, log, path_of):
+        """ Prints the worst shaped trees and largest inline containers; path_of(zoid) names them """
+        trees = list(self.trees())
+        containers = list(self.containers())
+        sparse = sorted((tree for tree in trees if tree[5] > 1), key=lambda tree: -tree[5] * (1.0 - tree[6]))
+        deep = sorted(trees, key=lambda tree: (-tree[2], -tree[7]))
+        inline = sorted(containers, key=lambda container: (-container[2], -container[3]))
+        log.info("Structure report: %d BTrees, %d inline containers", len(trees), len(containers))
+
+        print("  Sparsest BTrees (buckets x empty fraction):")
+        print("  %8s  %6s  %8s  %6s  %s" % ("Buckets", "Fill", "Items", "Depth", "Path (class)"))
+        for zoid, klass, depth, nodes, fanout, buckets, fill, items, size in sparse[:top]:
+            path = path_of(zoid)
+            print("  %8d  %5.1f%%  %8d  %6d  %s (%s)" % (buckets, 100*fill, items, depth, path, klass))
+            log.info("Sparse BTree %s (%s): %d buckets %1.1f%% full, %d items, depth %d, fan-out %1.1f, %d bytes",
+                     path, klass, buckets, 100*fill, items, depth, fanout, size)
+
+        print("  Deepest BTrees:")
+        print("  %6s  %8s  %8s  %7s  %s" % ("Depth", "Items", "Buckets", "Fan-out", "Path (class)"))
+        for zoid, klass, depth, nodes, fanout, buckets, fill, items, size in deep[:top]:
+            path = path_of(zoid)
+            print("  %6d  %8d  %8d  %7.1f  %s (%s)" % (depth, items, buckets, fanout, path, klass))
+            log.info("Deep BTree %s (%s): depth %d, %d items, %d buckets, fan-out %1.1f",
+                     path, klass, depth, items, buckets, fanout)
+
+        print("  Largest inline containers:")
+        print("  %8s  %12s  %s" % ("Entries", "MBytes", "Path (class)"))
+        for zoid, klass, entries, size in inline[:top]:
+            path = path_of(zoid)
+            print("  %8d  %12.1f  %s (%s)" % (entries, size/1048576.0, path, klass))
+            log.info("Inline container %s (%s): %d entries, %d bytes", path, klass, entries, size)
+
+
+WRITE_WINDOWS = (("1h", 3600), ("1d", 86400), ("7d", 7*86400), ("30d", 30*86400))
+
+
+def tid_time(tid):
+    """ Seconds since the epoch of a transaction id """
+    return TimeStamp(p64(tid)).timeTime()
+
+
+class WriteHotspots(object):
+    """ Objects and pickle bytes per group, in total and last written within each of WRITE_WINDOWS """
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, key, age, size):
+        totals = self.groups.get(key)
+        if totals is None:
+            totals = self.groups[key] = [0] * (2 + 2*len(WRITE_WINDOWS))
+        totals[0] += 1
+        totals[1] += size
+        for index, (label, seconds) in enumerate(WRITE_WINDOWS):
+            if age <= seconds:
+                totals[2 + 2*index] += 1
+                totals[3 + 2*index] += size
+
+    def report(self, title, top, log, name_of=str):
+        """ Prints the top groups by bytes written in the last day (then hour) and logs them all """
+        rows = sorted(self.groups.iteritems(), key=lambda row: (-row[1][5], -row[1][3], -row[1][1]))
+        print("  %s" % (title))
+        print("  %10s  %6s  %6s  %6s  %10s  %s" % ("Objects", "1h", "1d", "7d", "MBytes 1d", "Group"))
+        log.info(title)
+        for rank, (key, totals) in enumerate(rows):
+            name = name_of(key) if rank < top else key
+            if rank < top:
+                print("  %10d  %5.1f%%  %5.1f%%  %5.1f%%  %10.1f  %s" %
+                      (totals[0], 100.0*totals[2]/totals[0], 100.0*totals[4]/totals[0], 100.0*totals[6]/totals[0],
+                       totals[5]/1048576.0, name))
+            log.info("  %s: %d objects, %d bytes; written in %s", name, totals[0], totals[1],
+                     ", ".join("%s %d objects %d bytes" % (label, totals[2 + 2*index], totals[3 + 2*index])
+                               for index, (label, seconds) in enumerate(WRITE_WINDOWS)))
 
 
 def get_config(database=None):
@@ -129,9 +1007,128 @@ def get_config(database=None):
         return config
 
 
-class PKEReporter(object):
-    def __init__(self, db='zodb'):
+class TableScanner(object):
+    """
+    The table engine, shared by the live database and dump reporters; subclasses set
+    _dbname (the database pool workers connect to) and _tmpdir (for mmap-backed sets)
+    """
+    def scan_table(self, rows, root, log, workers=1, checkpoint=None, resume=False, parts_dir=None,
+                   export_refs=None, histogram=None, reachability=False):
+        """
+        Sequential two-pass scan of the object_state rows of rows (a TableRows or DumpRows):
+        pass one collects every existing zoid, pass two extracts the references of every
+        record and writes them to edge parts under parts_dir.  Returns (chains, reachable,
+        objects): [(parent zoid, missing zoid, chain), ...] for the dangling references,
+        sorted, with reachability the count of objects reachable from root (None otherwise),
+        and the count of existing objects.  chain holds the oids from root to the parent,
+        rebuilt from the parent through which the reachability sweep first reached every
+        object, or is None if the parent is not reachable from root.
+        Both passes are split into the zoid range slices of rows; with workers > 1 the slices
+        are scanned by a process pool.  Checkpoints record which slices of the current pass
+        are complete.  With export_refs, the edge parts are also merged into a ZenRefGraph file.
+        """
+        if resume:
+            meta, buffers = checkpoint.read()
+            if meta['engine'] != "table":
+                raise ValueError("%s was not written by the table engine" % (checkpoint.filename))
+            slices, done = meta['slices'], set(meta['done'])
+            existing = OidSet.frombuffer(buffers['existing'], meta['existing'], self._tmpdir)
+            packed = array(ZOID_TYPECODE, str(buffers['dangling'][:]))
+            dangling = set(zip(packed[0::2], packed[1::2]))
+            current_pass = meta['pass']
+            if histogram is not None:
+                histogram.update(meta.get('classes') or {})
+            log.info("Resumed table scan from %s: pass %d, %d of %d slices complete",
+                     checkpoint.filename, current_pass, len(done), len(slices))
+        else:
+            max_zoid = rows.max_zoid()
+            slices, done = rows.slices(max_zoid, workers), set()
+            existing = OidSet(max_zoid, self._tmpdir)
+            dangling = set()
+            current_pass = 1
+        _scan_worker['rows'] = rows
+        _scan_worker['histogram'] = histogram is not None
+        _scan_worker['export_dir'] = parts_dir
+        if not os.path.isdir(parts_dir):
+            os.makedirs(parts_dir)
+
+        def save_checkpoint():
+            pairs = array(ZOID_TYPECODE)
+            for pair in dangling:
+                pairs.extend(pair)
+            checkpoint.write({'engine': "table", 'pass': current_pass, 'slices': slices, 'done': sorted(done),
+                              'existing': len(existing),
+                              'classes': histogram and histogram.classes},
+                             {'existing': existing.getbuffer(),
+                              'dangling': pairs.tostring()})
+            log.debug("Checkpoint written to %s (pass %d, %d slices complete)",
+                      checkpoint.filename, current_pass, len(done))
+
+        if current_pass == 1:
+            progress_bar("Indexing", 25*len(done) // len(slices), 0)
+            remaining = [bounds for bounds in slices if bounds not in done]
+            for bounds, offset, bits, count in map_slices(index_zoid_slice, remaining, self._dbname, rows.batch_size,
+                                                          workers):
+                if count:
+                    existing.merge(offset, bits, count)
+                done.add(bounds)
+                progress_bar("Indexing", 25*len(done) // len(slices), 0)
+                if checkpoint and checkpoint.due():
+                    save_checkpoint()
+            log.info("Indexed %d existing objects", len(existing))
+            current_pass, done = 2, set()
+
+        # Forked workers inherit the existence set, it is never pickled
+        _scan_worker['existing'] = existing
+        remaining = [bounds for bounds in slices if bounds not in done]
+        for bounds, pairs, classes in map_slices(check_zoid_slice, remaining, self._dbname, rows.batch_size,
+                                                   workers):
+            dangling.update(pairs)
+            if classes:
+                histogram.update(classes)
+            done.add(bounds)
+            progress_bar("Scanning", 25 + 25*len(done) // len(slices), len(dangling))
+            if checkpoint and checkpoint.due():
+                save_checkpoint()
+        del _scan_worker['existing']
+
+        # Objects created during the scan lie beyond the zoids indexed by pass one
+        if dangling:
+            created = rows.existing(set(zoid for parent_zoid, zoid in dangling))
+            if created:
+                log.info("%d referenced objects were created during the scan", len(created))
+                dangling = set(pair for pair in dangling if pair[1] not in created)
+
+        del _scan_worker['export_dir']
+        parts = [refgraph_part(parts_dir, bounds) for bounds in slices]
+        reachable = None
+        chains = []
+        if reachability or dangling:
+            parents = ParentTable(8*len(existing.getbuffer()), self._tmpdir) if dangling else None
+            root_zoid = u64(root)
+            count = sweep_reachable(parts, root_zoid, self._tmpdir, parents)
+            if reachability:
+                reachable = count
+            for parent_zoid, zoid in sorted(dangling):
+                reached = parent_zoid == root_zoid or parents.get(parent_zoid) is not None
+                chains.append((parent_zoid, zoid, parents.ancestors(parent_zoid) if reached else None))
+        if export_refs:
+            node_count, edge_count = write_refgraph(export_refs, parts)
+            log.info("Exported %d references of %d objects to %s", edge_count, node_count, export_refs)
+        shutil.rmtree(parts_dir)
+
+        return chains, reachable, len(existing)
+
+
+class PKEReporter(TableScanner):
+    NAME_CACHE_SIZE = 10000     # (parent oid, child oid) -> (name, klass) resolved by analyze()
+    PATH_CACHE_SIZE = 1000      # ancestor chain -> (path, klass) of the chain's last object
+
+    def __init__(self, db='zodb', tmpdir=None):
         self._dbname = db
+        self._tmpdir = tmpdir
+        self._names = LRUCache(self.NAME_CACHE_SIZE)
+        self._paths = LRUCache(self.PATH_CACHE_SIZE)
         self._config = get_config(db)
         self._storage = self._config.storages[0].open()
         self._db = DB(self._storage)
@@ -139,17 +1136,34 @@ class PKEReporter(object):
         self._app = self._conn.root()
         self._size = self.get_total_count()
 
-    def get_total_count(self):
+    def _query(self, stmt, params=()):
         connmanager = self._storage._adapter.connmanager
         conn, cursor = connmanager.open()
         try:
-            cursor.execute("SELECT count(zoid) from object_state")
-            row = cursor.fetchone()
-            return long(row[0])
+            cursor.execute(stmt, params)
+            return cursor.fetchall()
         finally:
             connmanager.close(conn, cursor)
 
+    def get_total_count(self):
+        return long(self._query("SELECT count(zoid) from object_state")[0][0])
+
+    def get_max_zoid(self):
+        return long(self._query("SELECT max(zoid) from object_state")[0][0] or 0)
+
+    def get_max_tid(self):
+        return long(self._query("SELECT max(tid) from object_state")[0][0] or 0)
+
     def analyze(self, parent_oid, child_oid):
+        """ Returns (name, klass) of child_oid as referenced by parent_oid, memoized across reports """
+        key = (parent_oid, child_oid)
+        result = self._names.get(key)
+        if result is None:
+            result = self._analyze(parent_oid, child_oid)
+            self._names[key] = result
+        return result
+
+    def _analyze(self, parent_oid, child_oid):
         parent_state = self._storage.load(parent_oid)[0]
         pickler = Analyzer(parent_state, child_oid)
         pickler.load()
@@ -195,20 +1209,35 @@ class PKEReporter(object):
         repred = repr(oid)
         return u64ed, oid_0xstyle, repred
 
-    def report(self, oid, ancestors, log):
-        parent_oid = ancestors[-2]
-        parent_klass = None
+    def resolve_path(self, ancestors):
+        """ Returns (path, klass) of the last of ancestors, memoized per ancestor chain """
+        resolved = self._paths.get(ancestors)
+        if resolved is None:
+            klass = None
+            try:
+                immediate_parent = self._conn[ancestors[-1]]
+                klass = immediate_parent.__class__
+                path = immediate_parent.getPrimaryPath()
+            except Exception:
+                # Not a PrimaryPathObjectManager, do it manually
+                path = ['']
+                for (a, b) in zip(ancestors[:-1], ancestors[1:]):
+                    name, klass = self.analyze(a, b)
+                    path.append(name)
+            resolved = (path, klass)
+            self._paths[ancestors] = resolved
+        return resolved
+
+    def path_of(self, ancestors):
+        """ Returns the '/' separated path of the last of ancestors, best effort """
         try:
-            immediate_parent = self._conn[parent_oid]
-            parent_klass = immediate_parent.__class__
-            path = immediate_parent.getPrimaryPath()
+            return '/'.join(filter(None, self.resolve_path(tuple(ancestors))[0])) or '/'
         except Exception:
-            # Not a PrimaryPathObjectManager, do it manually
-            path = ['']
-            for (a, b) in zip(ancestors[:-2], ancestors[1:-1]):
-                name, klass = self.analyze(a, b)
-                path.append(name)
-            parent_klass = klass
+            return "0x%08x" % u64(ancestors[-1])
+
+    def report(self, oid, ancestors, log):
+        parent_oid = ancestors[-2]
+        path, parent_klass = self.resolve_path(tuple(ancestors[:-1]))
         path = filter(None, path)
         name, klass = self.analyze(*ancestors[-2:])
         par_u64, par_0x, par_rep = self.oid_versions(parent_oid)
@@ -225,77 +1254,694 @@ Refers to a missing object:
            par_u64=par_u64, par_0x=par_0x, par_rep=par_rep,
            oid_u64=oid_u64, oid_0x=oid_0x, oid_rep=oid_rep))
 
-    def verify(self, root, log, number_of_issues):
+    def report_unreachable(self, seen, log, batch_size, top):
+        """
+        Pack simulation: every existing zoid not seen by the traversal is garbage that
+        zenossdbpack would remove; they are grouped by class with their pickle sizes.
+        """
+        connmanager = self._storage._adapter.connmanager
+        unreachable = array(ZOID_TYPECODE)
+        for (zoid,) in iter_object_state(connmanager, "zoid", batch_size):
+            if zoid not in seen:
+                unreachable.append(zoid)
+
+        classes = {}
+        for zoid, size, header in load_object_state(connmanager, "zoid, LENGTH(state), SUBSTRING(state, 1, 512)",
+                                                    unreachable, batch_size):
+            klass = get_class_name(header or '') or "(unknown)"
+            count, total = classes.get(klass, (0, 0))
+            classes[klass] = (count + 1, total + (size or 0))
+
+        reclaimable = sum(total for count, total in classes.itervalues())
+        print("  Pack simulation: %d unreachable objects (%1.1f MB) would be reclaimed by zenossdbpack" %
+              (len(unreachable), reclaimable/1048576.0))
+        log.info("Pack simulation: %d unreachable objects, %d bytes reclaimable", len(unreachable), reclaimable)
+        print_class_table("Unreachable objects by class:", [(k, c, t) for k, (c, t) in classes.iteritems()], top, log)
+
+    def index_headers(self, batch_size, tids=False):
+        """
+        One pass over object_state reading only the length and the start of every record:
+        returns (max zoid, sizes, class ids, class names, tids or None), arrays indexed by zoid
+        """
+        connmanager = self._storage._adapter.connmanager
+        max_zoid = self.get_max_zoid()
+        sizes = array(ZOID_TYPECODE, [0]) * (max_zoid + 1)
+        class_ids = array('I', [0]) * (max_zoid + 1)
+        tid_table = array(ZOID_TYPECODE, [0]) * (max_zoid + 1) if tids else None
+        class_names = [None]
+        known = {None: 0}
+
+        progress_bar_chunk_size = (self._size//25) + 1
+        progress_bar("Indexing", 0, 0)
+        for scanned_count, (zoid, tid, size, header) in enumerate(iter_object_state(
+                connmanager, "zoid, tid, LENGTH(state), SUBSTRING(state, 1, 256)", batch_size), 1):
+            if zoid > max_zoid:
+                continue
+            klass = get_class_name(header or '')
+            if klass not in known:
+                known[klass] = len(class_names)
+                class_names.append(klass)
+            class_ids[zoid] = known[klass]
+            sizes[zoid] = size or 0
+            if tids:
+                tid_table[zoid] = tid
+            if (scanned_count % progress_bar_chunk_size) == 0:
+                progress_bar("Indexing", scanned_count // progress_bar_chunk_size, 0)
+        return max_zoid, sizes, class_ids, class_names, tid_table
+
+    @staticmethod
+    def model_kinds(class_names):
+        """ Returns 'link', 'device', 'deviceclass', 'path' (has a primary path) or None per class name """
+        kinds = []
+        for klass in class_names:
+            cls = resolve_class(klass) if klass else None
+            if not isinstance(cls, type):
+                kinds.append(None)
+            elif issubclass(cls, (ToOneRelationship, ToManyRelationship)):
+                kinds.append('link')
+            elif issubclass(cls, Device):
+                kinds.append('device')
+            elif issubclass(cls, DeviceClass):
+                kinds.append('deviceclass')
+            elif hasattr(cls, 'getPrimaryPath'):
+                kinds.append('path')
+            else:
+                kinds.append(None)
+        return kinds
+
+    def containment_tree(self, refs_filename, max_zoid, class_ids, kinds):
+        """
+        Breadth first walk of a reference graph written by --export-refs from the app root,
+        not following the links held by ToOne and ToMany (non containing) relationships, so
+        each object is reached from its container first: __primary_parent__ references always
+        lead back to an object already reached.  Returns (walk order, parent + 1 per zoid).
+        """
+        root = u64(self._app._p_oid)
+        parents = array(ZOID_TYPECODE, [0]) * (max_zoid + 1)     # containment parent + 1, 0 means unreached
+        parents[root] = root + 1
+        order = array(ZOID_TYPECODE, [root])
+        with RefGraph(refs_filename) as graph:
+            index = 0
+            while index < len(order):
+                zoid = order[index]
+                index += 1
+                if kinds[class_ids[zoid]] == 'link':
+                    continue
+                for ref in graph.references(zoid):
+                    if ref <= max_zoid and not parents[ref]:
+                        parents[ref] = zoid + 1
+                        order.append(ref)
+                if (index % 100000) == 0:
+                    progress_bar("Scanning", 25 + min(25, 25*index // self._size), 0)
+        return order, parents
+
+    def report_device_weights(self, refs_filename, log, batch_size, top):
+        """
+        Total objects and pickle bytes of every device's containment subtree (see
+        containment_tree), from a reference graph written by --export-refs.
+        """
+        max_zoid, sizes, class_ids, class_names, tids = self.index_headers(batch_size)
+        kinds = self.model_kinds(class_names)
+        order, parents = self.containment_tree(refs_filename, max_zoid, class_ids, kinds)
+        root = order[0]
+
+        counts = array(ZOID_TYPECODE, [0]) * (max_zoid + 1)
+        for zoid in reversed(order):
+            counts[zoid] += 1
+            if zoid != root:
+                parent = parents[zoid] - 1
+                counts[parent] += counts[zoid]
+                sizes[parent] += sizes[zoid]
+        progress_done(0)
+
+        def device_class_of(zoid):
+            parent = parents[zoid] - 1
+            while parent != zoid:
+                if kinds[class_ids[parent]] == 'deviceclass':
+                    return parent
+                zoid, parent = parent, parents[parent] - 1
+            return None
+
+        organizers = {None: "(none)"}
+        devices = []
+        classes = {}
+        for zoid in order:
+            if kinds[class_ids[zoid]] != 'device':
+                continue
+            organizer = device_class_of(zoid)
+            if organizer not in organizers:
+                try:
+                    organizers[organizer] = self._conn[p64(organizer)].getOrganizerName()
+                except Exception:
+                    organizers[organizer] = "0x%08x" % (organizer)
+            devices.append((counts[zoid], sizes[zoid], zoid, organizers[organizer]))
+            count, total, weight = classes.get(organizers[organizer], (0, 0, 0))
+            classes[organizers[organizer]] = (count + 1, total + counts[zoid], weight + sizes[zoid])
+
+        devices.sort(reverse=True, key=lambda device: (device[1], device[0]))
+        log.info("Subtree weights of %d devices computed from %s", len(devices), refs_filename)
+        print("  Heaviest devices (containment subtree):")
+        print("  %10s  %10s  %s" % ("Objects", "MBytes", "Device (device class)"))
+        for count, size, zoid, organizer in devices[:top]:
+            try:
+                name = self._conn[p64(zoid)].getPrimaryId()
+            except Exception:
+                name = "0x%08x" % (zoid)
+            print("  %10d  %10.1f  %s (%s)" % (count, size/1048576.0, name, organizer))
+            log.info("Device %s (%s): %d objects, %d bytes", name, organizer, count, size)
+        print_class_table("Device classes by subtree bytes (objects of all their devices):",
+                          [(organizer, total, weight) for organizer, (count, total, weight) in classes.iteritems()],
+                          top, log)
+
+    def report_write_hotspots(self, refs_filename, log, batch_size, top, path_depth):
+        """
+        Ages of the last write of every object (its object_state tid), relative to the newest
+        write, grouped by class and, given a reference graph, by the primary path prefix of
+        path_depth segments containing it.  With a history-free table every rewrite moves an
+        object's tid forward, so the share of a group written in the last hour or day tracks
+        how often it is rewritten.
+        """
+        max_zoid, sizes, class_ids, class_names, tids = self.index_headers(batch_size, tids=True)
+        newest = tid_time(max(tids)) if len(tids) else 0
+
+        classes = WriteHotspots()
+        for zoid in xrange(max_zoid + 1):
+            if tids[zoid]:
+                classes.add(class_names[class_ids[zoid]] or "(unknown)", newest - tid_time(tids[zoid]), sizes[zoid])
+
+        prefixes = None
+        if refs_filename:
+            kinds = self.model_kinds(class_names)
+            order, parents = self.containment_tree(refs_filename, max_zoid, class_ids, kinds)
+            root = order[0]
+            depths = array('H', [0]) * (max_zoid + 1)
+            prefix = array(ZOID_TYPECODE, [0]) * (max_zoid + 1)
+            prefix[root] = root
+            prefixes = WriteHotspots()
+            for zoid in order:
+                if zoid != root:
+                    parent = parents[zoid] - 1
+                    depths[zoid] = depths[parent] + (1 if kinds[class_ids[zoid]] else 0)
+                    prefix[zoid] = zoid if (kinds[class_ids[zoid]] and depths[zoid] <= path_depth) else prefix[parent]
+                if tids[zoid]:
+                    prefixes.add(prefix[zoid], newest - tid_time(tids[zoid]), sizes[zoid])
+        progress_done(0)
+
+        def path_name(zoid):
+            try:
+                return '/'.join(self._conn[p64(zoid)].getPrimaryPath()) or '/'
+            except Exception:
+                return "0x%08x" % (zoid)
+
+        print("  Last writes relative to the newest transaction (%s):" %
+              (strftime("%Y-%m-%d %H:%M:%S", localtime(newest))))
+        classes.report("Classes by bytes written in the last day:", top, log)
+        if prefixes is not None:
+            prefixes.report("Path prefixes (%d segments) by bytes written in the last day:" % (path_depth),
+                            top, log, path_name)
+
+    def verify(self, root, log, number_of_issues, checkpoint=None, resume=False, pack_report=False,
+               batch_size=10000, top=20, histogram=None, prefetch=0, workers=1, structures=None):
 
         database_size = self._size
-        scanned_count = 0
         progress_bar_chunk_size = 1
 
         if (database_size > 50):
             progress_bar_chunk_size = (database_size//50) + 1
 
-        inline_print("[%s]  Scanning  [%-50s] %3d%% " % (time.strftime("%Y-%m-%d %H:%M:%S"), '='*0, 0))
+        progress_bar("Scanning", 0, 0)
 
-        seen = set()
-        path = ()
-        stack = deque([(root, path)])
-        curstack, stack = stack, deque([])
-        while curstack or stack:
-            oid, path = curstack.pop()
-            scanned_count = len(seen)
+        if resume:
+            meta, buffers = checkpoint.read()
+            if meta['engine'] != "graph":
+                raise ValueError("%s was not written by the graph engine" % (checkpoint.filename))
+            seen = OidSet.frombuffer(buffers['seen'], meta['seen'], self._tmpdir)
+            parents = ParentTable.frombuffer(buffers['parents'], self._tmpdir)
+            curstack = deque(p64(z) for z in array(ZOID_TYPECODE, str(buffers['curstack'][:])))
+            stack = deque(p64(z) for z in array(ZOID_TYPECODE, str(buffers['stack'][:])))
+            reported = array(ZOID_TYPECODE, str(buffers['reported'][:]))
+            if histogram is not None:
+                histogram.update(meta.get('classes') or {})
+            for _ in xrange(meta['issues']):
+                number_of_issues.increment()
+            log.info("Resumed graph scan from %s: %d objects seen, %d queued, %d dangling references",
+                     checkpoint.filename, len(seen), len(curstack) + len(stack), meta['issues'])
+        else:
+            max_zoid = self.get_max_zoid()
+            seen = OidSet(max_zoid, self._tmpdir)
+            parents = ParentTable(max_zoid, self._tmpdir)
+            curstack, stack = deque([root]), deque([])
+            reported = array(ZOID_TYPECODE)    # (parent zoid, missing zoid) pairs
 
-            if (scanned_count % progress_bar_chunk_size) == 0:
-                chunk_number = scanned_count // progress_bar_chunk_size
-                if number_of_issues.value() > 2:
-                    inline_print("[%s]  CRITICAL  [%-50s] %3d%% [%d Dangling References]" %
-                                 (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number, number_of_issues.value()))
-                elif number_of_issues.value() == 1:
-                    inline_print("[%s]  CRITICAL  [%-50s] %3d%% [%d Dangling Reference]" %
-                                 (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number, number_of_issues.value()))
-                else:
-                    inline_print("[%s]  Scanning  [%-50s] %3d%% " % (time.strftime("%Y-%m-%d %H:%M:%S"), '='*chunk_number, 2*chunk_number))
+        def visit(oid, zoid, state):
+            if state is None:
+                self.report(oid, parents.ancestors(zoid), log)
+                number_of_issues.increment()
+                reported.extend((parents.get(zoid), zoid))
+                return
+            seen.add(zoid)
+            refs = set(get_refs(state))
+            for o in refs:
+                if isinstance(o, str) and u64(o) not in seen:
+                    parents.setdefault(u64(o), zoid)
+                    stack.append(o)
+            if histogram is not None:
+                histogram.add(state, len(refs))
+            if structures is not None:
+                structures.add(zoid, state)
 
-            if (oid not in seen):
-                try:
-                    state = self._storage.load(oid)[0]
-                    seen.add(oid)
-                except POSKeyError:
-                    self.report(oid, path, log)
-                    number_of_issues.increment()
+        prefetcher = Prefetcher(self._storage._adapter.connmanager, prefetch, workers) if prefetch else None
+        checkpoint_every = 1 if prefetcher else 1000    # loops are whole batches when prefetching
+        progress_chunk = 0
+        loop_count = 0
+        try:
+            while curstack or stack or (prefetcher and prefetcher.pending()):
+                if prefetcher:
+                    prefetcher.fill(curstack, seen)
+                    for oid, state in (prefetcher.next() if prefetcher.pending() else ()):
+                        zoid = u64(oid)
+                        if zoid not in seen:
+                            visit(oid, zoid, state)
                 else:
-                    refs = get_refs(state)
-                    stack.extend((o, path + (o,)) for o in set(refs) - seen)
+                    oid = curstack.pop()
+                    zoid = u64(oid)
+                    if (zoid not in seen):
+                        try:
+                            state = self._storage.load(oid)[0]
+                        except POSKeyError:
+                            state = None
+                        visit(oid, zoid, state)
 
-            if not curstack:
-                curstack = stack
-                stack = deque([])
+                if (len(seen) // progress_bar_chunk_size) != progress_chunk:
+                    progress_chunk = len(seen) // progress_bar_chunk_size
+                    progress_bar("Scanning", progress_chunk, number_of_issues.value())
 
-        if number_of_issues.value() > 0:
-            inline_print("[%s]  CRITICAL  [%-50s] %3.0d%% [%d Dangling References]\n" %
-                         (time.strftime("%Y-%m-%d %H:%M:%S"), '='*50, 100, number_of_issues.value()))
-        else:
-            inline_print("[%s]  Verified  [%-50s] %3.0d%%\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), '='*50, 100))
+                if not curstack:
+                    curstack = stack
+                    stack = deque([])
+
+                loop_count += 1
+                if checkpoint and (loop_count % checkpoint_every) == 0 and checkpoint.due():
+                    # Processed oids are done with, so the deques plus the oids still being
+                    # prefetched are the complete frontier
+                    frontier = array(ZOID_TYPECODE, (u64(o) for o in curstack))
+                    if prefetcher:
+                        frontier.extend(prefetcher.queued())
+                    checkpoint.write({'engine': "graph", 'seen': len(seen), 'issues': number_of_issues.value(),
+                                      'classes': histogram and histogram.classes},
+                                     {'seen': seen.getbuffer(), 'parents': parents.getbuffer(),
+                                      'curstack': frontier.tostring(),
+                                      'stack': array(ZOID_TYPECODE, (u64(o) for o in stack)).tostring(),
+                                      'reported': reported.tostring()})
+                    log.debug("Checkpoint written to %s (%d objects seen)", checkpoint.filename, len(seen))
+        finally:
+            if prefetcher:
+                prefetcher.close()
+
+        progress_done(number_of_issues.value())
+
+        if pack_report:
+            self.report_unreachable(seen, log, batch_size, top)
+
+        if structures is not None:
+            structures.report(top, log, lambda zoid: self.path_of(parents.ancestors(zoid)))
 
         return number_of_issues, len(seen), self._size
 
-    def run(self, log, number_of_issues):
+    def verify_table(self, root, log, number_of_issues, batch_size, workers=1, checkpoint=None, resume=False,
+                     export_refs=None, histogram=None):
+        """
+        Table engine: reports every dangling reference found by scan_table() with a
+        reference chain from root to its parent.  References held only by objects
+        unreachable from root are counted, not reported: the next pack removes them.
+        Returns the count of objects reachable from root.
+        """
+        workdir = os.path.dirname(checkpoint.filename) if checkpoint else tempfile.gettempdir()
+        parts_dir = os.path.join(workdir, "zodbscan_%s.parts" % (self._dbname))
+        rows = TableRows(self._storage._adapter.connmanager, batch_size)
+        chains, reachable, objects = self.scan_table(rows, root, log, workers, checkpoint, resume, parts_dir,
+                                                     export_refs, histogram, reachability=True)
+        unreachable = 0
+        for parent_zoid, zoid, chain in chains:
+            if chain is None:
+                log.info("0x%08x (missing 0x%08x) is not reachable from the root, not reported", parent_zoid, zoid)
+                unreachable += 1
+                continue
+            oid = p64(zoid)
+            self.report(oid, chain + (oid,), log)
+            number_of_issues.increment()
+
+        progress_done(number_of_issues.value())
+        if unreachable:
+            print("  %d dangling references are held only by unreachable objects (removed by the next pack)" %
+                  (unreachable))
+
+        return number_of_issues, reachable, self._size
+
+    def dangling_paths(self, log, batch_size, workers=1, workdir=None):
+        """
+        Locates dangling references for a Zope-level repair (findposkeyerror --prepass):
+        returns [(path, parent zoid, missing zoid), ...] where path is the primary path of
+        the nearest Zope object whose traversal touches the missing object - the closest
+        ancestor with a primary path, or the owner of a relationship.  References held only
+        by objects unreachable from the application root are logged and left out.  The
+        edge parts are written to workdir (the system temporary directory by default); returns
+        None if it lacks the room for them.
+        """
+        root = p64(1)
+        workdir = workdir or tempfile.gettempdir()
+        if not check_free_space(workdir, self.get_total_count(), log):
+            return None
+        parts_dir = os.path.join(workdir, "%s_prepass.parts" % (self._dbname))
+        rows = TableRows(self._storage._adapter.connmanager, batch_size)
+        chains, reachable, objects = self.scan_table(rows, root, log, workers, parts_dir=parts_dir)
+        progress_done(len(chains))
+        located = []
+        for parent_zoid, zoid, chain in chains:
+            if chain is None:
+                log.info("0x%08x (missing 0x%08x) is not reachable from the application root, skipped",
+                         parent_zoid, zoid)
+                continue
+            for ancestor in reversed(chain):
+                try:
+                    obj = self._conn[ancestor]
+                    path = obj.getPrimaryPath()
+                except Exception:
+                    continue
+                if isinstance(obj, RelationshipBase):
+                    path = path[:-1]
+                located.append((tuple(path), parent_zoid, zoid))
+                break
+            else:
+                located.append((('',), parent_zoid, zoid))
+        return located
+
+    def verify_incremental(self, log, number_of_issues, since_tid, batch_size):
+        """
+        Checks only the objects written after since_tid: their references are extracted and
+        the existence of every target is confirmed with batched lookups.  Objects that were
+        not rewritten are assumed unchanged since the previous scan.
+        """
+        connmanager = self._storage._adapter.connmanager
+        changed = [row[0] for row in self._query("SELECT zoid FROM object_state WHERE tid > %s", (since_tid,))]
+        log.info("%d objects written since tid %d", len(changed), since_tid)
+        progress_bar_chunk_size = (len(changed)//40) + 1
+
+        progress_bar("Scanning", 0, 0)
+        referrers = {}
+        for scanned_count, (zoid, state) in enumerate(load_object_state(connmanager, "zoid, state", changed,
+                                                                       batch_size), 1):
+            if (scanned_count % progress_bar_chunk_size) == 0:
+                progress_bar("Scanning", scanned_count // progress_bar_chunk_size, 0)
+            if not state:
+                continue
+            for ref in get_refs(state):
+                if isinstance(ref, str):
+                    referrers.setdefault(u64(ref), set()).add(zoid)
+
+        missing = set(referrers)
+        for (zoid,) in load_object_state(connmanager, "zoid", referrers, batch_size):
+            missing.discard(zoid)
+        progress_bar("Scanning", 45, len(missing))
+
+        for zoid in sorted(missing):
+            oid = p64(zoid)
+            for parent_zoid in sorted(referrers[zoid]):
+                self.report(oid, (p64(parent_zoid), oid), log)
+                number_of_issues.increment()
+
+        progress_done(number_of_issues.value())
+
+        return number_of_issues, len(changed), len(referrers)
+
+    def run(self, log, number_of_issues, engine="table", batch_size=10000, workers=1, checkpoint=None, resume=False,
+            since_tid=None, export_refs=None, pack_report=False, top=20, profile=False, profile_output=None,
+            prefetch=0, structure_report=False):
+        oid = '\x00\x00\x00\x00\x00\x00\x00\x01'
+
+        if since_tid is not None:
+            print("[%s] Examining items written to the '%s' database since tid %d:" %
+                  (strftime("%Y-%m-%d %H:%M:%S", localtime()), self._dbname, since_tid))
+            log.info("Examining items in %s database written since tid %d" % (self._dbname, since_tid))
+            with gc_cache_every(1000, self._db):
+                reported, changed, targets = self.verify_incremental(log, number_of_issues, since_tid, batch_size)
+            print("  %d changed objects, %d referenced objects checked" % (changed, targets))
+            print
+            return
+
         print("[%s] Examining %d items in the '%s' database:" %
               (strftime("%Y-%m-%d %H:%M:%S", localtime()), self._size,  self._dbname))
         log.info("Examining %d items in %s database" % (self._size, self._dbname))
 
-        oid = '\x00\x00\x00\x00\x00\x00\x00\x01'
+        if pack_report:
+            oid = p64(0)    # pack-gc keeps everything reachable from the database root, not just app
 
+        histogram = ClassHistogram() if (profile or profile_output) else None
+        structures = StructureStats() if structure_report else None
         with gc_cache_every(1000, self._db):
-            reported, scanned, total = self.verify(oid, log, number_of_issues)
+            if engine == "graph":
+                reported, scanned, total = self.verify(oid, log, number_of_issues, checkpoint, resume, pack_report,
+                                                       batch_size, top, histogram, prefetch, workers, structures)
+            else:
+                reported, scanned, total = self.verify_table(oid, log, number_of_issues, batch_size, workers,
+                                                             checkpoint, resume, export_refs, histogram)
+        if checkpoint:
+            checkpoint.remove()
+
+        if histogram is not None:
+            histogram.report(top, log, profile_output)
+
+        if scanned is not None:
+            warn_unreachable(self._dbname, scanned, total, log)
+        print
+
+
+class DumpReporter(TableScanner):
+    """
+    Offline table engine: scan_table() reads the object_state rows of a mysqldump (or
+    zenbackup) file instead of MySQL.  Reports carry the parent's class, the attribute name
+    found in its pickle and the oid chain from the root, but no path, as there is no
+    database to walk.
+    """
+    def __init__(self, filename, db='zodb', tmpdir=None):
+        self._dump = ObjectStateDump(filename, db)
+        self._dbname = db
+        self._tmpdir = tmpdir
+
+    def load_states(self, zoids):
+        """ Returns {zoid: state} of the given zoids, read with one more pass over the dump """
+        return dict((zoid, state) for zoid, tid, state in self._dump if zoid in zoids)
+
+    def report(self, parent_zoid, parent_state, zoid, chain, log):
+        oid = p64(zoid)
+        name = klass = None
+        try:
+            pickler = Analyzer(parent_state, oid)
+            pickler.load()
+            for k, v in pickler.load().iteritems():
+                if v is pickler._marker:
+                    name = k
+                    break
+            klass = pickler.klass
+        except Exception:
+            pass
+        par_u64, par_0x, par_rep = PKEReporter.oid_versions(p64(parent_zoid))
+        oid_u64, oid_0x, oid_rep = PKEReporter.oid_versions(oid)
+        log.critical(""" DANGLING REFERENCE (POSKeyError) FOUND:
+PATH: (oids, no names in a dump) {chain}
+TYPE: {type}
+OID:  {par_0x} {par_rep} {par_u64}
+Refers to a missing object:
+    NAME: {name}
+    TYPE: {klass}
+    OID:  {oid_0x} {oid_rep} {oid_u64} """.format(chain='/'.join("0x%08x" % u64(ancestor) for ancestor in chain),
+           type=get_class_name(parent_state or ''), name=name, klass=klass,
+           par_u64=par_u64, par_0x=par_0x, par_rep=par_rep,
+           oid_u64=oid_u64, oid_0x=oid_0x, oid_rep=oid_rep))
 
-        if (100.0*scanned/total) < 90.0:
-            print("  ** %3.2f%% of %s objects not reachable - examine your zenossdbpack settings **" %
-                  ((100.0-100.0*scanned/total), self._dbname))
-            log.info("%3.2f%% of %s objects not reachable - examine your zenossdbpack settings" %
-                     ((100.0-100.0*scanned/total), self._dbname))
+    def run(self, log, number_of_issues, workdir, top=20, profile=False, profile_output=None):
+        """ Scans the dump with its edge parts under workdir, returns False if workdir lacks the room for them """
+        print("[%s] Examining the '%s' database in %s:" %
+              (strftime("%Y-%m-%d %H:%M:%S", localtime()), self._dbname, self._dump.filename))
+        log.info("Examining %s database in %s" % (self._dbname, self._dump.filename))
+
+        histogram = ClassHistogram() if (profile or profile_output) else None
+        parts_dir = os.path.join(workdir, "zodbscan_%s_dump.parts" % (self._dbname))
+        chains, reachable, objects = self.scan_table(DumpRows(self._dump), p64(1), log, parts_dir=parts_dir,
+                                                     histogram=histogram, reachability=True)
+        states = self.load_states(set(parent_zoid for parent_zoid, zoid, chain in chains if chain is not None))
+        unreachable = 0
+        for parent_zoid, zoid, chain in chains:
+            if chain is None:
+                log.info("0x%08x (missing 0x%08x) is not reachable from the root, not reported", parent_zoid, zoid)
+                unreachable += 1
+                continue
+            self.report(parent_zoid, states.get(parent_zoid), zoid, chain, log)
+            number_of_issues.increment()
+
+        progress_done(number_of_issues.value())
+        if unreachable:
+            print("  %d dangling references are held only by unreachable objects (removed by the next pack)" %
+                  (unreachable))
+
+        if histogram is not None:
+            histogram.report(top, log, profile_output)
+        warn_unreachable(self._dbname, reachable, objects, log)
         print
 
 
+def database_filename(filename, database):
+    """ Per-database variant of a filename: /tmp/zodb.refs -> /tmp/zodb_zodb_session.refs """
+    root, ext = os.path.splitext(filename)
+    return "%s_%s%s" % (root, database, ext)
+
+
+def scan_database(zodb_name, cli_options, log, number_of_issues, suffix_filenames=False):
+    """ Runs the scan and reports selected by cli_options against one database, False if unable to """
+    cli_options = dict(cli_options)
+    if suffix_filenames:
+        for option in ('export_refs', 'profile_output', 'device_report', 'write_report'):
+            if cli_options[option]:
+                cli_options[option] = database_filename(cli_options[option], zodb_name)
+
+    mmap_dir = cli_options['tmpdir'] if cli_options['mmap'] else None
+
+    if cli_options['dump']:
+        try:
+            DumpReporter(cli_options['dump'], zodb_name, mmap_dir).run(log, number_of_issues, cli_options['tmpdir'],
+                                                                       cli_options['top'], cli_options['profile'],
+                                                                       cli_options['profile_output'])
+        except ValueError as e:
+            print("\n[%s] Unable to read %s: %s\n" %
+                  (strftime("%Y-%m-%d %H:%M:%S", localtime()), cli_options['dump'], e))
+            log.error("Unable to read %s: %s", cli_options['dump'], e)
+            return False
+        return True
+
+    minutes = DEFAULT_CHECKPOINT_MINUTES if cli_options['checkpoint'] is None else cli_options['checkpoint']
+    checkpoint = Checkpoint(os.path.join(cli_options['tmpdir'], "zodbscan_%s.checkpoint" % (zodb_name)),
+                            60*minutes, mmap_dir)
+    if cli_options['resume'] and not checkpoint.exists():
+        print("[%s] No checkpoint found at %s - unable to resume\n" %
+              (strftime("%Y-%m-%d %H:%M:%S", localtime()), checkpoint.filename))
+        log.error("No checkpoint found at %s - unable to resume", checkpoint.filename)
+        return False
+
+    # The tid mark only advances after an uninterrupted scan without dangling references,
+    # so known issues keep being reported until they are repaired
+    last_tid_file = os.path.join(cli_options['tmpdir'], "zodbscan_%s.lasttid" % (zodb_name))
+    since_tid = None
+    if cli_options['since_last_run'] and not cli_options['resume']:
+        since_tid = read_last_tid(last_tid_file)
+        if since_tid is None:
+            log.info("No previous scan recorded in %s - performing a full scan", last_tid_file)
+
+    if cli_options['export_refs'] and (cli_options['engine'] != "table" or since_tid is not None):
+        print("[%s] --export-refs requires a full scan with the table engine\n" %
+              (strftime("%Y-%m-%d %H:%M:%S", localtime())))
+        log.error("--export-refs requires a full scan with the table engine")
+        return False
+
+    if cli_options['pack_report'] and (cli_options['engine'] != "graph" or since_tid is not None):
+        print("[%s] --pack-report requires a full scan with the graph engine\n" %
+              (strftime("%Y-%m-%d %H:%M:%S", localtime())))
+        log.error("--pack-report requires a full scan with the graph engine")
+        return False
+
+    if cli_options['structure_report'] and (cli_options['engine'] != "graph" or since_tid is not None):
+        print("[%s] --structure-report requires a full scan with the graph engine\n" %
+              (strftime("%Y-%m-%d %H:%M:%S", localtime())))
+        log.error("--structure-report requires a full scan with the graph engine")
+        return False
+
+    # Tree nodes and buckets are not checkpointed, a resumed scan would only see part of them
+    if cli_options['structure_report'] and cli_options['resume']:
+        print("[%s] --structure-report cannot be combined with --resume\n" %
+              (strftime("%Y-%m-%d %H:%M:%S", localtime())))
+        log.error("--structure-report cannot be combined with --resume")
+        return False
+
+    if (cli_options['profile'] or cli_options['profile_output']) and since_tid is not None:
+        print("[%s] --profile requires a full scan\n" % (strftime("%Y-%m-%d %H:%M:%S", localtime())))
+        log.error("--profile requires a full scan")
+        return False
+
+    # --device-report and --write-report on their own only read an existing reference graph, no scan is run
+    reports = [cli_options['device_report'], cli_options['write_report']]
+    scan = cli_options['export_refs'] or all(report is None for report in reports)
+    for filename in reports:
+        if not scan and filename and not os.path.isfile(filename):
+            print("[%s] Unable to find reference graph %s - write one with --export-refs\n" %
+                  (strftime("%Y-%m-%d %H:%M:%S", localtime()), filename))
+            log.error("Unable to find reference graph %s", filename)
+            return False
+
+    reporter = PKEReporter(zodb_name, mmap_dir)
+    max_tid = reporter.get_max_tid()
+    # A full table scan writes every object's references to edge parts under --tmpdir
+    if scan and cli_options['engine'] == "table" and since_tid is None:
+        if not check_free_space(cli_options['tmpdir'], reporter.get_total_count(), log, cli_options['export_refs']):
+            return False
+    if scan:
+        reporter.run(log, number_of_issues, cli_options['engine'], cli_options['batchsize'],
+                     cli_options['workers'], checkpoint, cli_options['resume'], since_tid,
+                     cli_options['export_refs'], cli_options['pack_report'], cli_options['top'],
+                     cli_options['profile'], cli_options['profile_output'], cli_options['prefetch'],
+                     cli_options['structure_report'])
+    if cli_options['device_report']:
+        reporter.report_device_weights(cli_options['device_report'], log, cli_options['batchsize'],
+                                       cli_options['top'])
+    if cli_options['write_report'] is not None:
+        reporter.report_write_hotspots(cli_options['write_report'], log, cli_options['batchsize'],
+                                       cli_options['top'], cli_options['path_depth'])
+    if scan and cli_options['since_last_run'] and not cli_options['resume'] and number_of_issues.value() == 0:
+        write_last_tid(last_tid_file, max_tid)
+        log.info("Recorded tid %d in %s", max_tid, last_tid_file)
+    return True
+
+
+def _scan_database_process(zodb_name, cli_options, log, number_of_issues, output, log_queue):
+    with open(output, 'w') as f:
+        os.dup2(f.fileno(), sys.stdout.fileno())
+    ZenToolboxUtils.log_to_queue(log, log_queue)
+    succeeded = scan_database(zodb_name, cli_options, log, number_of_issues, suffix_filenames=True)
+    sys.exit(0 if succeeded else 1)
+
+
+def scan_databases(databases, cli_options, log, counters):
+    """
+    Scans several databases concurrently, one process (with its own connections) per database.
+    Each process writes its console output to a file under --tmpdir, printed when all are done,
+    and its log records through a WorkerLogListener.
+    """
+    print("[%s] Scanning the %s databases concurrently" %
+          (strftime("%Y-%m-%d %H:%M:%S", localtime()), ', '.join("'%s'" % (database) for database in databases)))
+    log.info("Scanning databases %s concurrently", ', '.join(databases))
+    outputs = [os.path.join(cli_options['tmpdir'], "zodbscan_%s.out" % (database)) for database in databases]
+    listener = ZenToolboxUtils.WorkerLogListener(log)
+    processes = [multiprocessing.Process(target=_scan_database_process, name="zodbscan-%s" % (database),
+                                         args=(database, cli_options, log, counter, output, listener.queue))
+                 for database, counter, output in zip(databases, counters, outputs)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    listener.stop()
+
+    succeeded = True
+    for database, process, output in zip(databases, processes, outputs):
+        if os.path.exists(output):
+            with open(output) as f:
+                sys.stdout.write(f.read())
+            os.remove(output)
+        if process.exitcode != 0:
+            print("[%s] Scan of the '%s' database failed (exit code %s)\n" %
+                  (strftime("%Y-%m-%d %H:%M:%S", localtime()), database, process.exitcode))
+            log.error("Scan of %s database failed (exit code %s)", database, process.exitcode)
+            succeeded = False
+    return succeeded
+
+
 def main():
     """Scans through ZODB checking objects for dangling references"""
 
@@ -304,6 +1950,53 @@ def main():
     scriptName = os.path.basename(__file__).split('.')[0]
     parser = ZenToolboxUtils.parse_options(scriptVersion, scriptName + scriptSummary + documentationURL)
     # Add in any specific parser arguments for %scriptName
+    parser.add_argument("-e", "--engine", action="store", default="table", choices=["table", "graph"],
+                        help="table: sequential scan of object_state (fast, needs about %d bytes per object free "
+                             "in --tmpdir for its reference lists), graph: traverse from the root object" %
+                             (REFS_BYTES_PER_OBJECT))
+    parser.add_argument("-b", "--batchsize", action="store", default=10000, type=int,
+                        help="number of object_state rows fetched per range query (table engine)")
+    parser.add_argument("-w", "--workers", action="store", default=1, type=int,
+                        help="number of worker processes (table engine) or --prefetch loader threads (graph "
+                             "engine), each with its own connection")
+    parser.add_argument("-f", "--prefetch", action="store", default=0, type=int, metavar="BATCH",
+                        help="load the graph frontier in bulk batches of BATCH objects ahead of the traversal "
+                             "(graph engine, 0 disables)")
+    parser.add_argument("-m", "--mmap", action="store_true", default=False,
+                        help="keep the OID sets in mmap-backed files under --tmpdir instead of RAM")
+    parser.add_argument("-c", "--checkpoint", action="store", default=None, type=int,
+                        help="minutes between checkpoints written to --tmpdir (default %d, 0 disables)" %
+                             (DEFAULT_CHECKPOINT_MINUTES))
+    parser.add_argument("-r", "--resume", action="store_true", default=False,
+                        help="resume from the last checkpoint in --tmpdir")
+    parser.add_argument("-i", "--since-last-run", action="store_true", default=False,
+                        help="only check objects written since the last clean --since-last-run scan")
+    parser.add_argument("-x", "--export-refs", action="store", default=None, type=str, metavar="FILENAME",
+                        help="write the reference graph to FILENAME for ZenRefGraph queries (table engine, needs "
+                             "about %d bytes per object free next to FILENAME)" % (REFGRAPH_BYTES_PER_OBJECT))
+    parser.add_argument("-k", "--pack-report", action="store_true", default=False,
+                        help="report the objects and bytes a pack would reclaim, by class (graph engine)")
+    parser.add_argument("-P", "--profile", action="store_true", default=False,
+                        help="report object count, pickle bytes and references per class")
+    parser.add_argument("-o", "--profile-output", action="store", default=None, type=str, metavar="FILENAME",
+                        help="write the per-class profile to FILENAME (JSON if it ends in .json, CSV otherwise)")
+    parser.add_argument("-d", "--dump", action="store", default=None, type=str, metavar="FILENAME",
+                        help="scan a mysqldump (plain or gzipped) or zenbackup tgz instead of the live database")
+    parser.add_argument("-S", "--structure-report", action="store_true", default=False,
+                        help="report badly shaped BTrees and large inline containers (graph engine)")
+    parser.add_argument("-g", "--device-report", action="store", default=None, type=str, metavar="FILENAME",
+                        help="report the heaviest device subtrees from a reference graph written by --export-refs "
+                             "(the scan is skipped unless --export-refs is given too)")
+    parser.add_argument("-W", "--write-report", action="store", nargs='?', const='', default=None, type=str,
+                        metavar="FILENAME", help="report recently rewritten objects by class, and by path prefix "
+                                                 "given a reference graph written by --export-refs (no scan)")
+    parser.add_argument("-l", "--path-depth", action="store", default=4, type=int,
+                        help="number of path segments grouped by --write-report")
+    parser.add_argument("-D", "--databases", action="store", default=None, type=str, metavar="DB[,DB...]",
+                        help="comma separated databases scanned concurrently (defaults to the zodb-db setting); "
+                             "output filenames get a _<database> suffix when several are given")
+    parser.add_argument("-t", "--top", action="store", default=20, type=int,
+                        help="number of rows printed in class reports")
     cli_options = vars(parser.parse_args())
     log, logFileName = ZenToolboxUtils.configure_logging(scriptName, scriptVersion, cli_options['tmpdir'])
     log.info("Command line options: %s" % (cli_options))
@@ -317,19 +2010,58 @@ def main():
     if not ZenToolboxUtils.get_lock("zenoss.toolbox", log):
         sys.exit(1)
 
-    number_of_issues = ZenToolboxUtils.Counter(0)
+    if cli_options['dump']:
+        if (cli_options['engine'] != "table" or cli_options['since_last_run'] or cli_options['resume'] or
+                cli_options['export_refs'] or cli_options['pack_report'] or cli_options['device_report'] or
+                cli_options['write_report'] is not None):
+            print("[%s] --dump only supports a full scan with the table engine\n" %
+                  (strftime("%Y-%m-%d %H:%M:%S", localtime())))
+            log.error("--dump only supports a full scan with the table engine")
+            sys.exit(1)
+        # A dump is read from the start by a single process, with no checkpoints and no object graph
+        unsupported = [option for option, given in (("--workers", cli_options['workers'] != 1),
+                                                    ("--prefetch", cli_options['prefetch']),
+                                                    ("--checkpoint", cli_options['checkpoint'] is not None),
+                                                    ("--structure-report", cli_options['structure_report']))
+                       if given]
+        if unsupported:
+            print("[%s] --dump cannot be combined with %s\n" %
+                  (strftime("%Y-%m-%d %H:%M:%S", localtime()), ', '.join(unsupported)))
+            log.error("--dump cannot be combined with %s", ', '.join(unsupported))
+            sys.exit(1)
+        if not os.path.isfile(cli_options['dump']):
+            print("[%s] Unable to find dump file %s\n" %
+                  (strftime("%Y-%m-%d %H:%M:%S", localtime()), cli_options['dump']))
+            log.error("Unable to find dump file %s", cli_options['dump'])
+            sys.exit(1)
+
+    if cli_options['databases']:
+        databases = [name.strip() for name in cli_options['databases'].split(',') if name.strip()]
+    else:
+        databases = [getGlobalConfiguration().get("zodb-db", "zodb")]
+    counters = [ZenToolboxUtils.Counter(0) for database in databases]
 
-    zodb_name = getGlobalConfiguration().get("zodb-db", "zodb")
+    if len(databases) == 1:
+        succeeded = scan_database(databases[0], cli_options, log, counters[0])
+    else:
+        succeeded = scan_databases(databases, cli_options, log, counters)
+    if not succeeded:
+        sys.exit(1)
 
-    PKEReporter(zodb_name).run(log, number_of_issues)
-    log.info("%d Dangling References were detected" % (number_of_issues.value()))
+    number_of_issues = sum(counter.value() for counter in counters)
+    if len(databases) > 1:
+        for database, counter in zip(databases, counters):
+            print("  %s: %d Dangling References" % (database, counter.value()))
+            log.info("%s: %d Dangling References", database, counter.value())
+        print
+    log.info("%d Dangling References were detected" % (number_of_issues))
 
     print("[%s] Execution finished in %s\n" % (strftime("%Y-%m-%d %H:%M:%S", localtime()),
                                                datetime.timedelta(seconds=int(time.time() - execution_start))))
     log.info("zodbscan completed in %1.2f seconds" % (time.time() - execution_start))
     log.info("############################################################")
 
-    if (number_of_issues.value() > 0):
+    if (number_of_issues > 0):
         print("** WARNING ** Dangling Reference(s) were detected - Consult KB article at")
         print("      https://support.zenoss.com/hc/en-us/articles/203118175\n")
         sys.exit(1)